@@ -14,6 +14,7 @@ __license__ = 'MIT'
 import os
 import logging
 from config import *
+from utilities import template_cache
 
 # Define an informal API for plugin implementations
 
@@ -52,6 +53,9 @@ plugin_dir          = os.path.join(installation_dir, 'plugins')
 
 config = load_config(os.path.join(installation_dir, 'etc/config'))
 
+# Pick up edited templates without a restart
+template_cache.reload = config.web.reload_templates
+
 # ------------------------------------------------------
 # Configure logger
 # ------------------------------------------------------
@@ -131,6 +131,50 @@ class CommandController(FeedController, UserController):
         except KeyboardInterrupt:
             print 'Interrupted by user'            
     
+    # Maintenance
+
+    def command_check(self, options, args):
+        '''Checks and repairs unread entries and feed counters of all users'''
+
+        for user in User.select():
+            self.user = user
+            missing_count, stale_count = self.check_unread_entries()
+            if missing_count or stale_count:
+                print 'Fixed %d missing and %d stale unread entries for user %s.' % (missing_count, stale_count, user.username)
+            wrong_count = self.check_feed_counters()
+            if wrong_count:
+                print 'Fixed entry counters of %d feeds for user %s.' % (wrong_count, user.username)
+        print 'Check completed.'
+
+    def command_explain(self, options, args):
+        '''Prints database query plans of the most frequent queries'''
+
+        self.user = self._get_user(options.username)
+        # Plans do not depend on actual values
+        now, feed_id, group_id = datetime.utcnow(), 0, 0
+        entries = Entry.select(Entry.id).join(Feed).where((Entry.feed == feed_id) & (Entry.last_updated_on < now))
+        queries = [
+            ('Fever items, latest', fever._q_entries_max(self.user)),
+            ('Fever items, since id', fever._q_entries_min(self.user, 0)),
+            ('Fever unread item ids', Unread.select(Unread.entry).where(Unread.user == self.user)),
+            ('Fever saved item ids', self.get_saved_entries(Entry.id)),
+            ('Fever feeds groups', fever._q_feed_groups(self.user)),
+            ('Fever recently read', Read.select(Read.entry).where((Read.user == self.user) & (Read.read_on > now))),
+            ('Unread entries', self.get_unread_entries().order_by(*frontend.ENTRIES_ORDER).limit(frontend.ENTRIES_PER_PAGE)),
+            ('All entries, next page', self.get_all_entries().where(frontend._entries_after(now, 0)).order_by(
+                *frontend.ENTRIES_ORDER).limit(frontend.ENTRIES_PER_PAGE)),
+            ('Group entries', self.get_group_entries(group_id).order_by(*frontend.ENTRIES_ORDER).limit(frontend.ENTRIES_PER_PAGE)),
+            ('Feed entries', self.get_feed_entries(feed_id).order_by(*frontend.ENTRIES_ORDER).limit(frontend.ENTRIES_PER_PAGE)),
+            ('Mark feed as read', Unread.select(Unread.entry).where((Unread.user == self.user) & (Unread.entry << entries))),
+            ('Feeds', self.get_feeds().order_by(Feed.title, Feed.id).limit(frontend.FEEDS_PER_PAGE)),
+            ('Feeds due for fetching', Feed.select().where((Feed.is_enabled == True) & (Feed.next_check_on <= now))),
+        ]
+
+        for label, q in queries:
+            print '%s:' % label
+            for step in explain(q):
+                print '    %s' % step
+
     # Setup and update
  
     def command_setup(self, options, args):
@@ -203,7 +247,7 @@ def read_password(prompt_label="Enter password: "):
 
     return password
     
-COMMANDS = 'import export serve setup upgrade fetch'.split()    
+COMMANDS = 'import export serve setup upgrade fetch check explain'.split()    
 
 def run():
 
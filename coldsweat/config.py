@@ -16,17 +16,28 @@ __all__ = [
     'load_config',
 ]
 
+SECTIONS = 'log', 'fetcher', 'web', 'plugins'
+
 DEFAULTS = {
     'min_interval'      : '900',
+    'max_interval'      : '86400',
     'max_errors'        : '50',
     'max_history'       : '7',
     'timeout'           : '10',
     'processes'         : '4',
+    'engine'            : 'pool',
+    'concurrency'       : '50',
+    'pool_size'         : '100',
+    'host_connections'  : '4',
     
     'level'             : 'INFO',
     'filename'          : '',       # Don't log
     
     'static_url'        : '',
+    'api_key_cache_ttl' : '300',
+    'api_key_cache_size': '100',
+    'reload_templates'  : 'no',
+    'preload_templates' : 'no',
     
     'load'              : ''
 }
@@ -39,10 +50,18 @@ def load_config(config_path):
 
     converters = {
         'min_interval'  : parser.getint,
+        'max_interval'  : parser.getint,
         'max_errors'    : parser.getint,
         'max_history'   : parser.getint,
         'timeout'       : parser.getint,
         'processes'     : parser.getint,
+        'concurrency'   : parser.getint,
+        'pool_size'     : parser.getint,
+        'host_connections': parser.getint,
+        'api_key_cache_ttl': parser.getint,
+        'api_key_cache_size': parser.getint,
+        'reload_templates': parser.getboolean,
+        'preload_templates': parser.getboolean,
     }
 
     if os.path.exists(config_path):
@@ -50,6 +69,11 @@ def load_config(config_path):
     else:
         raise RuntimeError('Could not find configuration file %s' % config_path)
 
+    # Missing sections get their default values too
+    for section in SECTIONS:
+        if not parser.has_section(section):
+            parser.add_section(section)
+
     config = Struct()    
     
     for section in parser.sections():
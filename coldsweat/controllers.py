@@ -11,7 +11,7 @@ import sys, os, re, time, urlparse
 from datetime import datetime
 from xml.etree import ElementTree
 
-from peewee import JOIN_LEFT_OUTER, fn, IntegrityError
+from peewee import JOIN_LEFT_OUTER, fn, IntegrityError, SQL, Param
 import feedparser
 import requests
 from requests.exceptions import *
@@ -23,7 +23,12 @@ from plugins import trigger_event, load_plugins
 from filters import escape_html, status_title
 from coldsweat import *
 from fetcher import *
+from favicon import fetch_icons
 
+PIPELINE_QUEUE_SIZE = 32 # Feeds waiting between fetching stages
+
+# (user id, name) -> (version, value) of data computed for a user
+_user_cache = {}
 
 class BaseController(object):
 
@@ -55,6 +60,15 @@ class UserController(BaseController):
         except IntegrityError:
             logger.debug(u'user %s already has feed %s in her subscriptions' % (self.user.username, feed.self_link))    
             return None
+
+        # Feed could be already subscribed in another group
+        q = Entry.select(Param(self.user.id), Entry.id).where((Entry.feed == feed) & 
+            ~fn.EXISTS(Read.select(SQL('1')).where((Read.user == self.user) & (Read.entry == Entry.id))) &
+            ~fn.EXISTS(Unread.select(SQL('1')).where((Unread.user == self.user) & (Unread.entry == Entry.id))))
+        Unread.insert_from([Unread.user, Unread.entry], q).execute()
+        for feed_id, (total, unread) in FeedCounter.count(self.user, feed).items():
+            FeedCounter.store(self.user, feed_id, total, unread)
+        Revision.bump(self.user, 'subscriptions', 'unread')
     
         logger.debug(u'subscribed user %s to feed %s' % (self.user.username, feed.self_link))                
         return subscription    
@@ -64,7 +78,68 @@ class UserController(BaseController):
         Remove a feed subscription for current user
         '''
         Subscription.delete().where((Subscription.user == self.user) & (Subscription.feed == feed)).execute()
+        Unread.delete().where((Unread.user == self.user) & 
+            (Unread.entry << Entry.select(Entry.id).where(Entry.feed == feed))).execute()
+        FeedCounter.delete().where((FeedCounter.user == self.user) & (FeedCounter.feed == feed)).execute()
+        Revision.bump(self.user, 'subscriptions', 'unread')
 
+    def check_unread_entries(self):
+        '''
+        Bring unread entries of current user in sync with subscriptions and 
+          read entries. Return the number of missing and stale entries found
+        '''
+        subscribed = is_subscribed(self.user)
+        is_read = fn.EXISTS(Read.select(SQL('1')).where((Read.user == self.user) & (Read.entry == Entry.id)))
+
+        with transaction():
+            q = Unread.select(Unread.entry).join(Entry).where((Unread.user == self.user) & (~subscribed | is_read)).naive()
+            stale_ids = [unread.entry_id for unread in q]
+            for ids in chunked(stale_ids):
+                Unread.delete().where((Unread.user == self.user) & (Unread.entry << ids)).execute()
+
+            q = Entry.select(Param(self.user.id), Entry.id).where(subscribed & ~is_read & 
+                ~fn.EXISTS(Unread.select(SQL('1')).where((Unread.user == self.user) & (Unread.entry == Entry.id))))
+            missing_count = q.count()
+            if missing_count:
+                Unread.insert_from([Unread.user, Unread.entry], q).execute()
+
+        if missing_count or stale_ids:
+            Revision.bump(self.user, 'unread')
+        return missing_count, len(stale_ids)
+
+    def check_feed_counters(self):
+        '''
+        Recount total and unread entries of current user feeds. Return
+          the number of feeds whose counters were found wrong
+        '''
+        with transaction():
+            counts = FeedCounter.count(self.user)
+            q = FeedCounter.select(FeedCounter.feed, FeedCounter.total, FeedCounter.unread).where(FeedCounter.user == self.user)
+            stored_counts = dict((feed_id, (total, unread)) for feed_id, total, unread in q.tuples())
+
+            stale_ids = [feed_id for feed_id in stored_counts if feed_id not in counts]
+            for ids in chunked(stale_ids):
+                FeedCounter.delete().where((FeedCounter.user == self.user) & (FeedCounter.feed << ids)).execute()
+
+            wrong_count = len(stale_ids)
+            for feed_id, (total, unread) in counts.items():
+                if stored_counts.get(feed_id) != (total, unread):
+                    FeedCounter.store(self.user, feed_id, total, unread)
+                    wrong_count += 1
+
+        return wrong_count
+
+    def get_cached(self, name, version, compute):
+        '''
+        Return a value computed for current user, calling compute 
+          again only when given version changes
+        '''
+        key = self.user.id, name
+        cached_version, value = _user_cache.get(key, (None, None))
+        if cached_version != version:
+            value = compute()
+            _user_cache[key] = version, value
+        return value
 
     # ------------------------------------------------------
     # Queries
@@ -87,6 +162,7 @@ class UserController(BaseController):
             if not count:
                 logger.debug(u'entry %s never marked as read, ignored' % entry.id)
                 return
+            Unread.create(user=self.user, entry=entry)
         elif status == 'saved':
             try:
                 Saved.create(user=self.user, entry=entry)
@@ -99,46 +175,84 @@ class UserController(BaseController):
                 logger.debug(u'entry %s never saved, ignored' % entry.id)
                 return
         
+        Revision.bump(self.user, 'saved' if status in ('saved', 'unsaved') else 'unread')
         logger.debug(u'entry %s %s' % (entry.id, status))
      
+    def mark_entries_read(self, *where):
+        '''
+        Mark as read all unread entries of current user matching given 
+          conditions on entries and their feeds, return their count
+        '''
+        entries = Entry.select(Entry.id).join(Feed).where(*where)
+        q = Unread.select(Unread.user, Unread.entry, Param(datetime.utcnow())).where(
+            (Unread.user == self.user) & (Unread.entry << entries))
+        with transaction():
+            count = insert_or_ignore(Read.insert_from([Read.user, Read.entry, Read.read_on], q))
+            FeedCounter.add_unread(self.user, Unread.select(Unread.entry).where(
+                (Unread.user == self.user) & (Unread.entry << entries)), -1)
+            Unread.delete().where((Unread.user == self.user) & (Unread.entry << entries)).execute()
+        if count:
+            Revision.bump(self.user, 'unread')
+        logger.debug(u'%d entries marked as read' % count)
+        return count
+
+    def get_entry_status(self, ids):
+        '''
+        Return which of given entry ids current user has read and saved
+        '''
+        return get_entry_status(self.user, ids)
+
     def get_unread_entries(self, *select):         
         #@@TODO: include saved information too
-        q = _q(*select).where((Subscription.user == self.user) &
-            ~(Entry.id << Read.select(Read.entry).where(Read.user == self.user))).distinct()
+        q = _q(is_unread(self.user), *select)
         return q
     
     def get_saved_entries(self, *select):   
         #@@TODO: include read information too
-        q = _q(*select).where((Subscription.user == self.user) & 
-            (Entry.id << Saved.select(Saved.entry).where(Saved.user == self.user))).distinct()
+        q = _q(is_subscribed(self.user), *select).where(
+            Entry.id << Saved.select(Saved.entry).where(Saved.user == self.user))
         return q
     
     def get_all_entries(self, *select):     
         #@@TODO: include read and saved information too
-        q = _q(*select).where(Subscription.user == self.user).distinct()
+        q = _q(is_subscribed(self.user), *select)
         return q    
     
     def get_group_entries(self, group, *select):     
         #@@TODO: include read and saved information too
-        q = _q(*select).where((Subscription.user == self.user) & (Subscription.group == group))
+        q = _q(is_subscribed(self.user, group), *select)
         return q
         
     def get_feed_entries(self, feed, *select):     
         #@@TODO: include read and saved information too
-        q = _q(*select).where((Subscription.user == self.user) & (Subscription.feed == feed)).distinct()
+        q = _q(is_subscribed(self.user), *select).where(Entry.feed == feed)
         return q
 
     # Feeds
     
     def get_feeds(self, *select):  
-        select = select or [Feed, fn.Count(Entry.id).alias('entry_count')]
-        q = Feed.select(*select).join(Entry, JOIN_LEFT_OUTER).switch(Feed).join(Subscription).where(Subscription.user == self.user).group_by(Feed)
+        # One counter for each subscribed feed, even if found in several groups
+        select = select or [Feed, FeedCounter.total.alias('entry_count'), FeedCounter.unread.alias('unread_count')]
+        q = Feed.select(*select).join(FeedCounter).where(FeedCounter.user == self.user).naive()
         return q  
 
+    def count_feed_entries(self, column, *where):
+        '''
+        Add up given counter column over current user feeds
+        '''
+        q = FeedCounter.select(fn.Sum(column)).where(FeedCounter.user == self.user, *where)
+        return q.scalar() or 0
+
     def get_group_feeds(self, group):
         q = Feed.select().join(Subscription).where((Subscription.user == self.user) & (Subscription.group == group))
         return q
     
+    # Icons
+
+    def get_icons(self, *select):
+        q = Icon.select(*select).join(Feed).join(Subscription).where(Subscription.user == self.user).distinct().order_by(Icon.id)
+        return q
+
     # Groups
     
     def get_groups(self):     
@@ -147,11 +261,42 @@ class UserController(BaseController):
 
 
  # Shortcut
-def _q(*select):
+def _q(where, *select):
     select = select or (Entry, Feed)
-    q = Entry.select(*select).join(Feed).join(Subscription)
+    q = Entry.select(*select).join(Feed).where(where)
     return q     
 
+def is_subscribed(user, group=None):
+    '''
+    Condition on entries to come from a feed user is subscribed to, 
+      in given group if any
+    '''
+    # Unlike a join with subscriptions this never yields duplicated 
+    #   rows and lets database walk entries in index order, checking 
+    #   each one against an index until page is full
+    where = (Subscription.user == user) & (Subscription.feed == Entry.feed)
+    if group:
+        where &= (Subscription.group == group)
+    return fn.EXISTS(Subscription.select(SQL('1')).where(where))
+
+def is_unread(user):
+    '''
+    Condition on entries to be unread by user, hence found in a subscribed feed
+    '''
+    # Walk entries in index order too instead of sorting all unread ones
+    return fn.EXISTS(Unread.select(SQL('1')).where((Unread.user == user) & (Unread.entry == Entry.id)))
+
+def get_entry_status(user, ids):
+    '''
+    Return which of given entry ids user has read and saved, looking 
+      up just those instead of all user read and saved entries
+    '''
+    if not ids:
+        return set(), set()
+    r = Read.select(Read.entry).where((Read.user == user) & (Read.entry << ids)).naive()
+    s = Saved.select(Saved.entry).where((Saved.user == user) & (Saved.entry << ids)).naive()
+    return set(i.entry_id for i in r), set(i.entry_id for i in s)
+
 
 
 
@@ -269,44 +414,164 @@ class FeedController(BaseController):
         logger.debug(u"starting fetcher")
         trigger_event('fetch_started')
             
-        if config.fetcher.processes:
+        if config.fetcher.engine == 'async':
+            counts = [self._fetch_feeds_async(feeds)]
+        elif config.fetcher.engine != 'pool':
+            raise ValueError('Unknown fetcher engine %s. Should be pool or async' % config.fetcher.engine)
+        elif config.fetcher.processes:
             from multiprocessing import Pool
-            # Each worker has its own connection
-            p = Pool(config.fetcher.processes, initializer=connect)
-            p.map(feed_worker, feeds)
+            # Each worker has its own connection and HTTP session
+            p = Pool(config.fetcher.processes, initializer=worker_init)
+            counts = p.map(feed_worker, feeds)
             # Exit the worker processes so their connections do not leak
             p.close()
+            p.join()
         else:
             # Just sequence requests in this process
-            for feed in feeds:
-                feed_worker(feed)
+            open_session()
+            counts = map(feed_worker, feeds)
+            close_session()
+
+        try:
+            # Icons are shared by feeds on the same domain, fetch them once
+            counts.append(fetch_icons(feeds))
+        finally:
+            # Entries are saved by now, do not let icons hold clients back
+            set_last_refreshed_on(datetime.utcnow())
         
         trigger_event('fetch_done', feeds)
         
-        logger.info(u"%d feeds checked in %.2fs" % (len(feeds), time.time() - start))        
+        request_count, reused_count = [sum(values) for values in zip(*counts)] or (0, 0)
+        logger.info(u"%d feeds checked in %.2fs, %d HTTP requests made, %d over reused connections" % (
+            len(feeds), time.time() - start, request_count, reused_count))
         
 
+    def _fetch_feeds_async(self, feeds):
+        """
+        Fetch feeds in stages: many threads download feeds, a pool of 
+          processes parses them and this process alone saves results. 
+          Return HTTP requests made and how many of them reused a connection
+        """
+        from multiprocessing import Pool, cpu_count
+        from Queue import Queue, Empty
+        import threading
+
+        # Parsing is CPU bound, do not spawn more processes than cores
+        processes = min(config.fetcher.processes, cpu_count())
+        if processes:
+            # Each worker has its own connection, but no HTTP session 
+            #   since it just parses. Fork workers before any thread is started
+            p = Pool(processes, initializer=worker_init, initargs=(False,))
+        else:
+            p = None
+
+        feed_queue, save_queue = Queue(), Queue(PIPELINE_QUEUE_SIZE)
+        for feed in feeds:
+            feed_queue.put(feed)
+
+        # Bound the downloaded feeds waiting to be parsed
+        parse_slots = threading.BoundedSemaphore(PIPELINE_QUEUE_SIZE)
+
+        def parsed(fetcher):
+            parse_slots.release()
+            if fetcher:
+                save_queue.put(fetcher)
+
+        def download():
+            while True:
+                try:
+                    feed = feed_queue.get_nowait()
+                except Empty:
+                    return
+                fetcher, response = fetch_worker(feed)
+                if not fetcher:
+                    continue # Not due yet
+                if p:
+                    parse_slots.acquire()
+                    p.apply_async(parse_worker, (fetcher, response), callback=parsed)
+                else:
+                    fetcher = parse_worker(fetcher, response)
+                    if fetcher:
+                        save_queue.put(fetcher)
+
+        def wait(threads):
+            for thread in threads:
+                thread.join()
+            if p:
+                p.close()
+                # Wait for pending parse results
+                p.join()
+            save_queue.put(None) # Done
+
+        # Downloading threads share a single session
+        open_session()
+
+        downloaders = [threading.Thread(target=download) 
+            for index in range(min(config.fetcher.concurrency, len(feeds)) or 1)]
+
+        for thread in downloaders + [threading.Thread(target=wait, args=(downloaders,))]:
+            # Do not keep process alive if saving fails
+            thread.daemon = True
+            thread.start()
+
+        # A single writer avoids lock contention between workers
+        while True:
+            fetcher = save_queue.get()
+            if not fetcher:
+                break
+            try:
+                fetcher.save()
+            except Exception:
+                # Keep saving the other feeds
+                logger.exception(u"unexpected error while saving %s" % fetcher.feed.self_link)
+
+        return close_session()
+
     def fetch_all_feeds(self):
         """
-        Fetch all enabled feeds, possibly parallelizing requests
+        Fetch all enabled feeds due for a check, possibly parallelizing requests
         """
     
-        q = Feed.select().where(Feed.is_enabled==True)
+        q = Feed.select().where((Feed.is_enabled==True) & (Feed.next_check_on <= datetime.utcnow()))
         
         feeds = list(q)
         if not feeds:
-            logger.debug(u"no feeds found to fetch, halted")
+            logger.debug(u"no feeds due for fetching, halted")
             return
     
         self.fetch_feeds(feeds)
 
 
+def worker_init(with_session=True):
+    from multiprocessing.util import Finalize
+    connect()
+    if with_session:
+        open_session()
+        # Close pooled connections when worker process exits
+        Finalize(None, close_session, exitpriority=10)
+
 def feed_worker(feed):
+    request_count, reused_count = get_session_counts()
     fetcher = Fetcher(feed)
     fetcher.update_feed()
+    # Let caller add up requests made by all workers
+    counts = get_session_counts()
+    return counts[0] - request_count, counts[1] - reused_count
 
         
         
 
-
-
+def fetch_worker(feed):
+    fetcher = Fetcher(feed)
+    if not fetcher.is_due():
+        return None, None
+    return fetcher, fetcher.fetch()
+
+def parse_worker(fetcher, response):
+    try:
+        fetcher.process_response(response)
+    except Exception:
+        # Keep the pipeline going with the other feeds
+        logger.exception(u"unexpected error while processing %s" % fetcher.feed.self_link)
+        return None
+    return fetcher
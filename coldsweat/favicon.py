@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+'''
+Description: the favicon fetcher
+
+Copyright (c) 2013—2016 Andrea Peltrin
+License: MIT (see LICENSE for details)
+'''
+
+import urlparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+from HTMLParser import HTMLParseError
+
+from requests.exceptions import *
+
+from coldsweat import *
+from models import *
+from utilities import *
+from fetcher import fetch_url, open_session, close_session
+from markup import find_icon_links
+
+__all__ = [
+    'fetch_icons',
+    'fetch_icon',
+]
+
+FETCH_ICONS_DELTA   = 30  # Days
+
+def fetch_icons(feeds):
+    '''
+    Update stale icons of given feeds, fetching each site icon once per domain.
+      Return HTTP requests made and how many of them reused a connection
+    '''
+    instant = datetime.utcnow()
+    expired_on = instant - timedelta(days=FETCH_ICONS_DELTA)
+
+    stale_feeds = []
+    for ids in chunked(feed.id for feed in feeds):
+        q = Feed.select(Feed.id, Feed.self_link, Feed.alternate_link).where(
+            (Feed.id << ids) & (Feed.is_enabled == True) &
+            ((Feed.icon_last_updated_on >> None) | (Feed.icon_last_updated_on < expired_on))).naive()
+        stale_feeds.extend(q)
+
+    feed_ids, site_urls = defaultdict(list), {}
+    for feed in stale_feeds:
+        # Prefer alternate_link if available since self_link could
+        #   point to Feed Burner or similar services
+        site_url = feed.alternate_link or feed.self_link
+        domain = urlparse.urlsplit(site_url).hostname
+        if not domain:
+            continue
+        feed_ids[domain].append(feed.id)
+        site_urls.setdefault(domain, site_url)
+
+    if not feed_ids:
+        return 0, 0
+
+    # Look up icons already fetched for other feeds on the same domains
+    icons = {}
+    domains = feed_ids.keys()
+    for chunk in chunked(domains):
+        q = Favicon.select(Favicon.domain, Favicon.icon).where((Favicon.domain << chunk) &
+            (Favicon.last_updated_on >= expired_on))
+        icons.update((favicon.domain, favicon.icon_id) for favicon in q)
+
+    missing_domains = [domain for domain in domains if domain not in icons]
+    counts = 0, 0
+    if missing_domains:
+        from multiprocessing.pool import ThreadPool
+
+        open_session()
+        try:
+            p = ThreadPool(min(config.fetcher.concurrency, len(missing_domains)))
+            fetched_icons = p.map(fetch_icon, [site_urls[domain] for domain in missing_domains])
+            p.close()
+        finally:
+            counts = close_session()
+
+        for domain, data in zip(missing_domains, fetched_icons):
+            # Identical icons are stored once
+            icons[domain] = icon_id = Icon.store(data)
+            count = Favicon.update(icon=icon_id, last_updated_on=instant).where(Favicon.domain == domain).execute()
+            if not count:
+                Favicon.create(domain=domain, icon=icon_id, last_updated_on=instant)
+
+    with transaction():
+        for domain, ids in feed_ids.items():
+            for chunk in chunked(ids):
+                Feed.update(icon=icons[domain], icon_last_updated_on=instant).where(Feed.id << chunk).execute()
+
+    logger.debug(u"updated icons for %d domains, %d fetched" % (len(domains), len(missing_domains)))
+    return counts
+
+def fetch_icon(site_url):
+    '''
+    Fetch a site favicon, using the default icon if anything goes wrong
+    '''
+    try:
+        return _fetch_icon(site_url)
+    except Exception:
+        # Malformed pages and URLs must not stop other domains
+        logger.exception(u"unexpected error while fetching favicon for %s, using default" % site_url)
+        return Feed.DEFAULT_ICON
+
+def _fetch_icon(site_url):
+    '''
+    Fetch a site favicon trying its /favicon.ico first, then the icons
+      listed in its home page and finally a third-party service
+    '''
+    parts = urlparse.urlsplit(site_url)
+
+    data = _fetch_image(urlparse.urlunsplit((parts.scheme, parts.netloc, '/favicon.ico', '', '')))
+    if data:
+        return data
+
+    try:
+        response = fetch_url(site_url, timeout=config.fetcher.timeout)
+        links = find_icon_links(response.text, base_url=response.url) if response.ok else []
+    except (RequestException, HTMLParseError), exc:
+        logger.debug(u"could not find icon links for %s (%s)" % (site_url, exc))
+        links = []
+
+    for url in links:
+        # Icon could be inlined in page
+        if url.startswith('data:image/'):
+            return url
+        data = _fetch_image(url)
+        if data:
+            return data
+
+    data = _fetch_image("http://www.google.com/s2/favicons?domain=%s" % parts.hostname)
+    if data:
+        return data
+
+    logger.debug(u"could not fetch favicon for %s, using default" % site_url)
+    return Feed.DEFAULT_ICON
+
+def _fetch_image(url):
+    '''
+    Return image found at URL as data URI or None
+    '''
+    try:
+        response = fetch_url(url, timeout=config.fetcher.timeout)
+    except RequestException, exc:
+        logger.debug(u"could not fetch favicon %s (%s)" % (url, exc))
+        return None
+
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+    if response.ok and response.content and content_type.startswith('image/'):
+        logger.debug(u"fetched favicon %s" % url)
+        return make_data_uri(content_type, response.content)
+
+    return None
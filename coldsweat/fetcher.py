@@ -7,12 +7,15 @@ Portions are copyright (c) 2013 Rui Carmo
 License: MIT (see LICENSE for details)
 '''
 
-import sys, os, re, time, urlparse
-from datetime import datetime
+import sys, os, re, time, urlparse, threading
+from datetime import datetime, timedelta
+from hashlib import sha1
 
 from peewee import IntegrityError
+from playhouse.signals import pre_save
 import feedparser
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import *
 from webob.exc import *
 
@@ -30,11 +33,12 @@ __all__ = [
     'Fetcher',
     'validate_url',
     'scrub_url',
-    'fetch_url'
+    'fetch_url',
+    'open_session',
+    'close_session',
+    'get_session_counts',
 ]
 
-FETCH_ICONS_DELTA = 30 # Days
-
 class Fetcher(object):
     '''
     Fetch a single given feed
@@ -48,6 +52,16 @@ class Fetcher(object):
  
         self.feed = feed
 
+        # New entries, saved all at once along with feed
+        self.entries = []
+
+        # Used to adapt the check interval after fetching
+        self.error_count, self.timestamps = feed.error_count, []
+        if feed.last_checked_on and feed.next_check_on:
+            self.last_interval = datetime_as_epoch(feed.next_check_on) - datetime_as_epoch(feed.last_checked_on)
+        else:
+            self.last_interval = 0
+
 # @@TODO    
 #       def handle_500(self, response):
 #         '''
@@ -88,7 +102,7 @@ class Fetcher(object):
         '''
         Not modified
         '''
-        self.feed.last_status = response.status_code
+        self.feed.last_status = HTTPNotModified.code
         logger.debug(u"%s hasn't been modified, skipped" % self.netloc)               
         raise HTTPNotModified
 
@@ -117,6 +131,13 @@ class Fetcher(object):
         OK plus redirects
         '''
         self.feed.etag   = response.headers.get('ETag', None)
+
+        # Many servers ignore conditional GETs, compare bodies instead
+        content_hash = sha1(response.content).hexdigest()
+        if content_hash == self.feed.content_hash:
+            self.handle_304(response)
+        self.feed.content_hash = content_hash
+
         # Save final status code discarding redirects
         self.feed.last_status = response.status_code
 
@@ -125,10 +146,20 @@ class Fetcher(object):
 
 
     def update_feed(self):
-                
+        '''
+        Fetch and process feed in one go
+        '''
+        if not self.is_due():
+            return
+        response = self.fetch()
+        self.update_feed_with_response(response)
+
+    def is_due(self):
+        '''
+        Check feed freshness against the minimum fetch interval
+        '''
         logger.debug(u"updating %s" % self.netloc)
                
-        # Check freshness
         for value in [self.feed.last_checked_on, self.feed.last_updated_on]:
             if not value:
                 continue
@@ -138,19 +169,44 @@ class Fetcher(object):
             delta = datetime_as_epoch(self.instant) - datetime_as_epoch(value)    
             if delta < config.fetcher.min_interval:
                 logger.debug(u"%s is below minimun fetch interval, skipped" % self.netloc)
-                return                                      
-        
+                return False
+
+        return True
+
+    def fetch(self):
+        '''
+        Issue the network request for feed, return None on errors. 
+          This does not touch the database so it's safe to call 
+          from several threads at once
+        '''
         try:
-            response = fetch_url(self.feed.self_link, 
+            return fetch_url(self.feed.self_link, 
                 timeout=config.fetcher.timeout, 
                 etag=self.feed.etag, 
                 modified_since=self.feed.last_updated_on)
         except RequestException: 
+            logger.warn(u"a network error occured while fetching %s, skipped" % self.netloc)
+            return None
+
+    def update_feed_with_response(self, response):
+        self.process_response(response)
+        self.save()
+
+    def update_feed_with_data(self, data):
+        self._parse_feed(data)
+        self._schedule()
+        self.save()
+
+    def process_response(self, response):
+        '''
+        Figure out feed status and parse its entries. Database is only 
+          read here, call save() to actually store changes
+        '''
+        if response is None:
             # Record any network error as 'Service Unavailable'
             self.feed.last_status   =  HTTPServiceUnavailable.code
             self.feed.error_count   += 1   
-            logger.warn(u"a network error occured while fetching %s, skipped" % self.netloc)
-            self.feed.save()            
+            self._schedule()
             return
     
         self.feed.last_checked_on = self.instant
@@ -170,7 +226,6 @@ class Fetcher(object):
                 logger.warn(u"%s replied with status %d, aborted" % (self.netloc, status))
                 return
             self._parse_feed(response.text)
-            self._fetch_icon()
         except (HTTPError, HTTPNotModified, DuplicatedFeedError):
             return # Bail out
         finally:
@@ -178,11 +233,62 @@ class Fetcher(object):
                 self._synthesize_entry('Feed has accomulated too many errors (last was %s).' % filters.status_title(status))
                 logger.warn(u"%s has accomulated too many errors, disabled" % self.netloc)
                 self.feed.is_enabled = False
+            self._schedule()
+
+    def save(self):
+        '''
+        Save feed and its new entries in a single transaction
+        '''
+        names = [field.name for field in Entry._meta.sorted_fields if field is not Entry._meta.primary_key]
+        
+        saved_count = 0
+        with transaction():
+            # Each row takes a parameter per column
+            for entries in chunked(self.entries, PARAMS_PER_QUERY // len(names)):
+                rows = []
+                for entry in entries:
+                    # Fire the usual signal to fill in the GUID hash
+                    pre_save.send(entry, created=True)
+                    # Multi-row inserts need the same columns for every row
+                    rows.append(dict((name, entry._data.get(name)) for name in names))
+                # Another feed may have carried the same entries since parsing
+                count = insert_or_ignore(Entry.insert_many(rows))
+                if not count:
+                    continue
+                # New entries are unread for all feed subscribers
+                q = Subscription.select(Subscription.user, Entry.id).join(Entry, on=(Subscription.feed == Entry.feed)).where(
+                    (Subscription.feed == self.feed) & (Entry.guid_hash << [row['guid_hash'] for row in rows])).distinct()
+                Unread.insert_from([Unread.user, Unread.entry], q).execute()
+                FeedCounter.update(total=FeedCounter.total + count, unread=FeedCounter.unread + count).where(
+                    FeedCounter.feed == self.feed).execute()
+                saved_count += count
             self.feed.save()
-            
-    def update_feed_with_data(self, data):
-        self._parse_feed(data)
-        self.feed.save()
+        
+        if saved_count < len(self.entries):
+            logger.debug(u"%d entries from %s already saved by another feed, skipped" % (len(self.entries) - saved_count, self.netloc))
+        if saved_count:
+            logger.debug(u"saved %d new entries from %s" % (saved_count, self.netloc))
+
+    def _schedule(self):
+        '''
+        Set next feed check, adapting interval to the feed publishing rate
+        '''
+        min_interval, max_interval = config.fetcher.min_interval, config.fetcher.max_interval
+
+        if self.feed.error_count > self.error_count:
+            # Back off exponentially on consecutive errors
+            interval = min_interval * 2 ** min(self.feed.error_count, 16)
+        elif self.entries and len(self.timestamps) > 1:
+            # Average time between entries found in document
+            timestamps = sorted(self.timestamps)
+            interval = (datetime_as_epoch(timestamps[-1]) - datetime_as_epoch(timestamps[0])) / (len(timestamps) - 1)
+        else:
+            # Not modified or no new entries, double previous interval
+            interval = 2 * self.last_interval
+
+        interval = max(min_interval, min(interval, max_interval))
+        self.feed.next_check_on = self.instant + timedelta(seconds=interval)
+        logger.debug(u"%s will be checked again in %ds" % (self.netloc, interval))
                       
     def _parse_feed(self, data):
 
@@ -197,36 +303,40 @@ class Fetcher(object):
         self.feed.alternate_link     = ft.get_alternate_link()        
         self.feed.title              = self.feed.title or ft.get_title() # Do not set again if already set
 
-        #entries = []
         feed_author = ft.get_author()
 
+        candidates = []
         for entry_dict in soup.entries:
-    
             t = EntryTranslator(entry_dict)
-            
             link = t.get_link()
-            guid = t.get_guid(default=link)
+            candidates.append((t, link, t.get_guid(default=link)))
+
+        # Look up already stored entries with a few queries, not one per entry
+        seen_hashes = get_existing_guid_hashes(make_sha1_hash(guid) for t, link, guid in candidates if guid)
+
+        for t, link, guid in candidates:
     
             if not guid:
                 logger.warn(u'could not find GUID for entry from %s, skipped' % self.netloc)
                 continue
 
-            timestamp               = t.get_timestamp(self.instant)
-            content_type, content   = t.get_content(('text/plain', ''))
+            timestamp = t.get_timestamp(self.instant)
+            self.timestamps.append(timestamp)
         
             # Skip ancient entries        
             if config.fetcher.max_history and (self.instant - timestamp).days > config.fetcher.max_history:
                 logger.debug(u"entry %s from %s is over maximum history, skipped" % (guid, self.netloc))
                 continue
     
-            try:
-                # If entry is already in database with same hashed GUID, skip it
-                Entry.get(guid_hash=make_sha1_hash(guid)) 
+            # If entry is already in database (or document) with same hashed GUID, skip it
+            guid_hash = make_sha1_hash(guid)
+            if guid_hash in seen_hashes:
                 logger.debug(u"duplicated entry %s, skipped" % guid)
                 continue
-            except Entry.DoesNotExist:
-                pass
+            seen_hashes.add(guid_hash)
     
+            content_type, content = t.get_content(('text/plain', ''))
+
             entry = Entry(
                 feed              = self.feed,                
                 guid              = guid,
@@ -239,45 +349,16 @@ class Fetcher(object):
             )
             
             # At this point we are pretty sure we doesn't have the entry 
-            #  already in the database so alert plugins and save data
-            trigger_event('entry_parsed', entry, entry_dict)
-            entry.save()
-            #@@TODO: entries.append(entry)
+            #  already in the database so alert plugins and queue it for saving
+            trigger_event('entry_parsed', entry, t.entry_dict)
+            self.entries.append(entry)
     
             logger.debug(u"parsed entry %s from %s" % (guid, self.netloc))  
         
-        #return entries
-        
-
-    def _fetch_icon(self):
-    
-        if not self.feed.icon or not self.feed.icon_last_updated_on or (self.instant - self.feed.icon_last_updated_on).days > FETCH_ICONS_DELTA:
-            # Prefer alternate_link if available since self_link could 
-            #   point to Feed Burner or similar services
-            self.feed.icon                  = self._google_favicon_fetcher(self.feed.alternate_link or self.feed.self_link)
-            self.feed.icon_last_updated_on  = self.instant
-
-            logger.debug(u"fetched favicon %s..." % (self.feed.icon[:70]))    
-
-    
-    def _google_favicon_fetcher(self, url):
-        '''
-        Fetch a site favicon via Google service
-        '''
-        endpoint = "http://www.google.com/s2/favicons?domain=%s" % urlparse.urlsplit(url).hostname
-    
-        try:
-            response = fetch_url(endpoint)
-        except RequestException, exc:
-            logger.warn(u"could not fetch favicon for %s (%s)" % (url, exc))
-            return Feed.DEFAULT_ICON
-    
-        return make_data_uri(response.headers['Content-Type'], response.content)
-
 
     def add_synthesized_entry(self, title, content_type, content):
         '''
-        Create an HTML entry for this feed 
+        Create an HTML entry for this feed, saved along with the feed 
         '''
     
         # Since we don't know the mechanism the feed used to build a GUID for its entries 
@@ -295,7 +376,7 @@ class Fetcher(object):
             content_type      = content_type,
             last_updated_on   = self.instant
         )
-        entry.save()
+        self.entries.append(entry)
         logger.debug(u"synthesized entry %s" % guid)    
         return entry
     
@@ -401,6 +482,16 @@ class EntryTranslator(object):
         return None
 
 
+def get_existing_guid_hashes(guid_hashes):
+    '''
+    Return which of the given GUID hashes are already in the database
+    '''
+    existing = set()
+    for chunk in chunked(set(guid_hashes)):
+        q = Entry.select(Entry.guid_hash).where(Entry.guid_hash << chunk).naive()
+        existing.update(entry.guid_hash for entry in q)
+    return existing
+
 # --------------------
 # URL utilities
 # --------------------
@@ -442,19 +533,103 @@ def fetch_url(url, timeout=10, etag=None, modified_since=None):
         'User-Agent': USER_AGENT
     }
 
-    # Conditional GET headers
-    if etag and modified_since:
+    # Conditional GET headers, servers may honour just one of them
+    if etag:
         request_headers['If-None-Match'] = etag
+    if modified_since:
         request_headers['If-Modified-Since'] = format_http_datetime(modified_since)
         
     try:
-        response = requests.get(url, timeout=timeout, headers=request_headers)
+        # Reuse pooled connections while a fetch session is open
+        response = (_session or requests).get(url, timeout=timeout, headers=request_headers)
     except RequestException, exc:
         logger.debug(u"tried to fetch %s but got %s" % (url, exc.__class__.__name__))
         raise exc
     
     return response
 
+# ------------------------------------------------------
+# Pooled HTTP sessions
+# ------------------------------------------------------
+
+class PooledAdapter(HTTPAdapter):
+    '''
+    Keep-alive connections for each host, tracking how many 
+      requests have been served by already open connections
+    '''
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        self.request_count, self.connection_count = 0, 0
+        self._host_slots, self._lock = {}, threading.Lock()
+        # Collect stats before evicted host pools get closed
+        self.poolmanager.pools.dispose_func = self._dispose_pool
+
+    def _dispose_pool(self, pool):
+        self.request_count      += pool.num_requests
+        self.connection_count   += pool.num_connections
+        pool.close()
+
+    def send(self, request, stream=False, **kwargs):
+        # Cap connections to the same host here, since a blocking 
+        #   urllib3 pool loses its slots on connection errors
+        host = urlparse.urlsplit(request.url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self._pool_maxsize)
+        with self._host_slots[host]:
+            response = super(PooledAdapter, self).send(request, stream=stream, **kwargs)
+            if not stream:
+                response.content # Read body and release connection
+        return response
+
+    def get_counts(self):
+        '''
+        Return requests made so far and how many of them reused a connection
+        '''
+        pools = self.poolmanager.pools
+        request_count, connection_count = self.request_count, self.connection_count
+        for key in pools.keys():
+            request_count       += pools[key].num_requests
+            connection_count    += pools[key].num_connections
+        return request_count, request_count - connection_count
+
+_session = None
+
+def open_session():
+    '''
+    Start a pooled HTTP session, used by fetch_url until close_session is called
+    '''
+    global _session
+    
+    adapter = PooledAdapter(
+        pool_connections    = config.fetcher.pool_size, 
+        pool_maxsize        = config.fetcher.host_connections)
+    
+    _session = requests.Session()
+    _session.mount('http://', adapter)
+    _session.mount('https://', adapter)
+
+def get_session_counts():
+    '''
+    Return requests made by current session and how many of them reused a connection
+    '''
+    if not _session:
+        return 0, 0
+    return _session.get_adapter('http://').get_counts()
+
+def close_session():
+    '''
+    Close pooled connections, return requests made and how many of them reused a connection
+    '''
+    global _session
+    
+    counts = get_session_counts()
+    if _session:
+        _session.close()
+        _session = None
+    return counts
+    
 # ------------------------------------------------------
 # Custom error codes 9xx & exceptions 
 # ------------------------------------------------------
@@ -6,7 +6,7 @@ Copyright (c) 2013—2016 Andrea Peltrin
 Portions are copyright (c) 2013 Rui Carmo
 License: MIT (see LICENSE for details)
 """
-import re, json
+import re, json, zlib
 from collections import defaultdict
 from datetime import datetime, timedelta
 
@@ -22,8 +22,17 @@ from models import *
 
 RE_DIGITS           = re.compile('[0-9]+')
 RECENTLY_READ_DELTA = 10*60 # 10 minutes
+ITEMS_PER_PAGE      = 50
+JSON_CHUNK_SIZE     = 16*1024
 API_VERSION         = 3
 COMMANDS = 'groups feeds items unread_item_ids saved_item_ids mark unread_recently_read favicons links'.split()
+# Revision counters telling when data returned by a command change
+COMMAND_REVISIONS = {
+    'groups'          : ('subscriptions',),
+    'feeds'           : ('subscriptions',),
+    'unread_item_ids' : ('unread',),
+    'saved_item_ids'  : ('subscriptions', 'saved'), # Saved entries of subscribed feeds only
+}
     
 class FeverApp(WSGIApp, FeedController, UserController):
 
@@ -48,28 +57,76 @@ class FeverApp(WSGIApp, FeedController, UserController):
 
         # Authorized
         self.user = user        
+        self.revision = None
         result.auth = 1            
+        result.last_refreshed_on_time = get_last_refreshed_on_time()
             
         # It looks like client *can* send multiple commands at time
-        for name in COMMANDS:
-            if name in self.request.params:           
-                try:
-                    handler = getattr(self, '%s_command' % name)
-                except AttributeError:
-                    logger.debug(u'unrecognized command %s, skipped' % name) 
-                    continue        
-                handler(result)        
-    
-        result.last_refreshed_on_time = get_last_refreshed_on_time()
-    
-        return self.respond_with_json(result)
+        commands = [name for name in COMMANDS if name in self.request.params]
+
+        etag = self.get_etag(commands, result.last_refreshed_on_time)
+        if etag and etag in self.request.if_none_match:
+            logger.debug(u'%s for user %s not modified' % (', '.join(commands), self.user.username))
+            return HTTPNotModified(etag=etag)
+
+        for name in commands:
+            try:
+                handler = getattr(self, '%s_command' % name)
+            except AttributeError:
+                logger.debug(u'unrecognized command %s, skipped' % name) 
+                continue        
+            handler(result)        
+    
+        response = self.respond_with_json(result)
+        if etag:
+            response.etag = etag
+        return response
+
+    def get_etag(self, commands, last_refreshed_on_time):
+        '''
+        Return a validator for the response to given commands, or None 
+          if any of them cannot tell cheaply when its data change
+        '''
+        if not commands:
+            return None
+
+        # Fetcher updates feeds and unread entries of all users
+        versions = ['%s:%s' % (API_VERSION, last_refreshed_on_time)]
+        for name in commands:
+            if name == 'favicons':
+                # Icons are stored by content, so their ids and hashes 
+                #   tell if client has already got them all
+                q = self.get_icons(Icon.id, Icon.data_hash).naive()
+                version = ','.join('%d:%s' % (icon.id, icon.data_hash) for icon in q)
+                if has_default_icon(self.user):
+                    version = '0,%s' % version
+            elif name in COMMAND_REVISIONS:
+                version = ','.join(str(getattr(self.get_revision(), counter)) for counter in COMMAND_REVISIONS[name])
+            else:
+                return None
+            versions.append('%s=%s' % (name, version))
+
+        return make_sha1_hash(';'.join(versions))
+
+    def get_revision(self):
+        if not self.revision:
+            self.revision = Revision.get_or_create(self.user)
+        return self.revision
+
+    def get_feed_groups(self):
+        return self.get_cached('feeds_groups', self.get_revision().subscriptions, 
+            lambda: get_feed_groups(self.user))
         
     def respond_with_json(self, data):
-        json_data = json.dumps(data, indent=4)
+        app_iter = _buffer(_iterencode(data))
         response = Response(
-            json_data, 
+            app_iter=app_iter, 
             content_type='application/json',
             charset='utf-8')        
+        response.vary = ('Accept-Encoding',)
+        if 'gzip' in self.request.accept_encoding:
+            response.app_iter = _gzip(app_iter)
+            response.content_encoding = 'gzip'
         return response
 
     # ------------------------------------------------------
@@ -82,24 +139,25 @@ class FeverApp(WSGIApp, FeedController, UserController):
             'id'    : group.id, 
             'title' : group.title
         } for group in q]
-        result.feeds_groups = get_feed_groups(self.user)
+        result.feeds_groups = self.get_feed_groups()
             
     def feeds_command(self, result):
         q = self.get_feeds()
         result.feeds = [{
             'id'                  : feed.id,
-            'favicon_id'          : feed.id, 
+            'favicon_id'          : feed.icon_id or 0, 
             'title'               : feed.title,
             'url'                 : feed.self_link,
             'site_url'            : feed.alternate_link,
             'is_spark'            : 0, # Unsupported
             'last_updated_on_time': feed.last_updated_on_as_epoch  
         } for feed in q]        
-        result.feeds_groups = get_feed_groups(self.user)
+        if 'feeds_groups' not in result:
+            result.feeds_groups = self.get_feed_groups()
     
     def unread_item_ids_command(self, result):
-        q = self.get_unread_entries(Entry.id).naive()        
-        ids = [r.id for r in q]
+        q = Unread.select(Unread.entry).where(Unread.user == self.user).naive()        
+        ids = [r.entry_id for r in q]
         result.unread_item_ids = ','.join(map(str, ids))
                 
     def saved_item_ids_command(self, result):
@@ -108,15 +166,18 @@ class FeverApp(WSGIApp, FeedController, UserController):
         result.saved_item_ids = ','.join(map(str, ids))
     
     def favicons_command(self, result):
-        q = Feed.select()
+        q = self.get_icons(Icon.id, Icon.data).naive()
         result.favicons = [{
-            'id': feed.id,
-            'data': feed.icon_or_default
-        } for feed in q]
+            'id': icon.id,
+            'data': icon.data
+        } for icon in q]
+        # Feeds still without an icon point to this one
+        if has_default_icon(self.user):
+            result.favicons.insert(0, {'id': 0, 'data': Feed.DEFAULT_ICON})
     
     def items_command(self, result):
     
-        result.total_items = self.get_all_entries(Entry.id).count()
+        result.total_items = self.count_feed_entries(FeedCounter.total)
     
         # From the API: "Use the since_id argument with the highest id 
         #  of locally cached items to request 50 additional items.         
@@ -134,8 +195,8 @@ class FeverApp(WSGIApp, FeedController, UserController):
         if 'max_id' in self.request.GET: 
             try:
                 max_id = int(self.request.GET['max_id'])
-                if max_id: 
-                    result.items = get_entries_max(self.user, max_id)            
+                # Zero means latest items
+                result.items = get_entries_max(self.user, max_id)            
             except ValueError:
                 pass
     
@@ -146,18 +207,25 @@ class FeverApp(WSGIApp, FeedController, UserController):
         if 'with_ids' in self.request.GET: 
             with_ids = self.request.GET['with_ids']        
             ids = [int(i) for i in with_ids.split(',') if RE_DIGITS.match(i)]
-            result.items = get_entries(self.user, ids[:50])
+            result.items = get_entries(self.user, ids[:ITEMS_PER_PAGE]) if ids else []
             return
         
-        # Unfiltered results
-        result.items = get_entries(self.user)
+        # Unfiltered results, latest items first
+        result.items = get_entries_max(self.user)
     
     
     
     def unread_recently_read_command(self, result):    
         since = datetime.utcnow() - timedelta(seconds=RECENTLY_READ_DELTA)    
-        q = Read.delete().where((Read.user==self.user) & (Read.read_on > since)) 
-        count = q.execute()
+        with transaction():
+            where = (Read.user == self.user) & (Read.read_on > since) & is_subscribed(self.user)
+            FeedCounter.add_unread(self.user, Read.select(Read.entry).join(Entry).where(where), 1)
+            q = Read.select(Read.user, Read.entry).join(Entry).where(where)
+            Unread.insert_from([Unread.user, Unread.entry], q).execute()
+            q = Read.delete().where((Read.user==self.user) & (Read.read_on > since)) 
+            count = q.execute()
+        if count:
+            Revision.bump(self.user, 'unread')
         logger.debug(u'%d entries marked as unread' % count)
      
         
@@ -192,6 +260,7 @@ class FeverApp(WSGIApp, FeedController, UserController):
                 if not count:
                     logger.debug(u'entry %d never marked as read, ignored' % object_id)
                     return
+                Unread.create(user=self.user, entry=entry)
             elif status == 'saved':
                 try:
                     Saved.create(user=self.user, entry=entry)
@@ -203,7 +272,11 @@ class FeverApp(WSGIApp, FeedController, UserController):
                 if not count:
                     logger.debug(u'entry %d never marked as saved, ignored' % object_id)
                     return
-                      
+            else:
+                logger.debug(u'unrecognized status %s for entry %d, ignored' % (status, object_id))
+                return
+
+            Revision.bump(self.user, 'saved' if status in ('saved', 'unsaved') else 'unread')
             logger.debug(u'marked entry %d as %s' % (object_id, status))
     
     
@@ -223,23 +296,8 @@ class FeverApp(WSGIApp, FeedController, UserController):
                 logger.debug(u'missing or invalid parameter (%s), ignored' % ex)
                 return              
             
-            q = Entry.select(Entry).join(Feed).join(Subscription).where(
-                (Subscription.user == self.user) &
-                (Subscription.feed == feed) & 
-                # Exclude entries already marked as read
-                ~(Entry.id << Read.select(Read.entry).where(Read.user == self.user)) &
-                # Exclude entries fetched after last sync
-                (Entry.last_updated_on < before)
-            ).distinct().naive()
-    
-            with transaction():
-                for entry in q:
-                    try:
-                        Read.create(user=self.user, entry=entry)
-                    except IntegrityError:
-                        # Should not happen, due to the query above, log as warning
-                        logger.warn(u'entry %d already marked as read, ignored' % entry.id)
-                        continue
+            # Exclude entries fetched after last sync
+            self.mark_entries_read(Entry.feed == feed, Entry.last_updated_on < before)
             
             logger.debug(u'marked feed %d as %s' % (object_id, status))
                     
@@ -255,13 +313,8 @@ class FeverApp(WSGIApp, FeedController, UserController):
     
             # Mark all as read?
             if object_id == 0:                                                
-                q = Entry.select(Entry).join(Feed).join(Subscription).where(
-                    (Subscription.user == self.user) &
-                    # Exclude entries already marked as read
-                    ~(Entry.id << Read.select(Read.entry).where(Read.user == self.user)) &
-                    # Exclude entries fetched after last sync
-                    (Entry.last_updated_on < before)
-                ).distinct().naive()
+                # Exclude entries fetched after last sync
+                self.mark_entries_read(Entry.last_updated_on < before)
             else:
                 try:        
                     group = Group.get(Group.id == object_id)  
@@ -269,23 +322,8 @@ class FeverApp(WSGIApp, FeedController, UserController):
                     logger.debug(u'could not find group %d, ignored' % object_id)
                     return
     
-                q = Entry.select(Entry).join(Feed).join(Subscription).where(
-                    (Subscription.user == self.user) &
-                    (Subscription.group == group) & 
-                    # Exclude entries already marked as read
-                    ~(Entry.id << Read.select(Read.entry).where(Read.user == self.user)) &
-                    # Exclude entries fetched after last sync
-                    (Entry.last_updated_on < before)
-                ).distinct().naive()
-    
-            with transaction():
-                for entry in q:                
-                    try:
-                        Read.create(user=self.user, entry=entry)
-                    except IntegrityError:
-                        # Should not happen thanks to the query above, log as warning
-                        logger.warn(u'entry %d already marked as read, ignored' % entry.id)
-                        continue
+                feeds = Subscription.select(Subscription.feed).where((Subscription.user == self.user) & (Subscription.group == group))
+                self.mark_entries_read(Entry.feed << feeds, Entry.last_updated_on < before)
             
             logger.debug(u'marked group %d as %s' % (object_id, status))
     
@@ -301,34 +339,83 @@ class FeverApp(WSGIApp, FeedController, UserController):
 def setup_app():
     return FeverApp()
 
+# ------------------------------------------------------
+# JSON encoding
+# ------------------------------------------------------
+
+def _iterencode(data):
+    '''
+    Encode data as compact JSON, one list item at time
+    '''
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    yield '{'
+    for index, (key, value) in enumerate(dict.iteritems(data)):
+        yield '%s%s:' % (',' if index else '', encode(key))
+        if isinstance(value, list):
+            yield '['
+            for item_index, item in enumerate(value):
+                yield '%s%s' % (',' if item_index else '', encode(item))
+            yield ']'
+        else:
+            yield encode(value)
+    yield '}'
+
+def _buffer(pieces, size=JSON_CHUNK_SIZE):
+    '''
+    Join pieces into chunks of at least given size
+    '''
+    chunk, length = [], 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+def _gzip(chunks):
+    # Let zlib write gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
 # ------------------------------------------------------
 # Specific Fever queries
 # ------------------------------------------------------
         
+def _q_feed_groups(user):
+    # Ids alone are found in the subscriptions index
+    return Subscription.select(Subscription.group, Subscription.feed).where(
+        Subscription.user == user).order_by(Subscription.group, Subscription.feed)
+
+def has_default_icon(user):
+    q = Feed.select(Feed.id).join(Subscription).where((Subscription.user == user) & (Feed.icon >> None))
+    return q.exists()
+
 def get_feed_groups(user):
-    q = Subscription.select(Subscription, Feed, Group).join(Feed).switch(Subscription).join(Group).where(Subscription.user == user)
     groups = defaultdict(lambda: [])
-    for s in q:
-        groups[s.group.id].append(str(s.feed.id))
+    for group_id, feed_id in _q_feed_groups(user).tuples():
+        groups[group_id].append(str(feed_id))
     result = []
-    for g in groups:
+    for g in sorted(groups):
         result.append({'group_id':g, 'feed_ids':','.join(groups[g])})
     return result
 
 
 def _get_entries(user, q):
 
-    r = Entry.select(Entry.id).join(Read).where(Read.user == user).naive()
-    s = Entry.select(Entry.id).join(Saved).where(Saved.user == user).naive()
-    
-    read_ids    = dict((i.id, None) for i in r)
-    saved_ids   = dict((i.id, None) for i in s)
+    entries = list(q)
+    read_ids, saved_ids = get_entry_status(user, [entry.id for entry in entries])
     
     result = []
-    for entry in q:
+    for entry in entries:
         result.append({
             'id': entry.id,
-            'feed_id': entry.feed.id,
+            'feed_id': entry.feed_id,
             'title': entry.title,
             'author': entry.author,
             'html': entry.content,
@@ -339,32 +426,42 @@ def _get_entries(user, q):
         })
     return result 
     
-def get_entries(user, ids=None):
+def _q_entries(user):
+    return Entry.select().where(is_subscribed(user))
 
-    if ids:
-        where_clause = (Subscription.user == user) & (Entry.id << ids)
-    else:
-        where_clause = (Subscription.user == user)
-    
-    q = Entry.select(Entry, Feed).join(Feed).join(Subscription).where(where_clause).distinct()
-    return _get_entries(user, q) 
+def _q_entries_min(user, min_id, bound=ITEMS_PER_PAGE):
+    return _q_entries(user).where(Entry.id > min_id).order_by(Entry.id.asc()).limit(min(bound, ITEMS_PER_PAGE))
 
-def get_entries_min(user, min_id, bound=50):
-    q = Entry.select(Entry, Feed).join(Feed).join(Subscription).where((Subscription.user == user) & (Entry.id > min_id)).distinct().limit(bound)
-    return _get_entries(user, q) 
+def _q_entries_max(user, max_id=0, bound=ITEMS_PER_PAGE):
+    q = _q_entries(user)
+    if max_id:
+        q = q.where(Entry.id < max_id)
+    return q.order_by(Entry.id.desc()).limit(min(bound, ITEMS_PER_PAGE))
 
-def get_entries_max(user, max_id, bound=50):
-    q = Entry.select(Entry, Feed).join(Feed).join(Subscription).where((Subscription.user == user) & (Entry.id < max_id)).distinct().limit(bound)
+def get_entries(user, ids):
+    q = _q_entries(user).where(Entry.id << ids).order_by(Entry.id)
     return _get_entries(user, q) 
 
+def get_entries_min(user, min_id, bound=ITEMS_PER_PAGE):
+    '''
+    Return a page of entries following min_id, oldest first
+    '''
+    return _get_entries(user, _q_entries_min(user, min_id, bound)) 
+
+def get_entries_max(user, max_id=0, bound=ITEMS_PER_PAGE):
+    '''
+    Return a page of entries preceding max_id or the latest ones, newest first
+    '''
+    return _get_entries(user, _q_entries_max(user, max_id, bound)) 
+
 
 def get_last_refreshed_on_time():
     """
-    Time of the most recently *refreshed* feed
+    Time the last feeds refresh completed
     """
-    last_checked_on = Feed.select().aggregate(fn.Max(Feed.last_checked_on))
-    if last_checked_on:        
-        return datetime_as_epoch(last_checked_on)
+    last_refreshed_on = get_last_refreshed_on()
+    if last_refreshed_on:        
+        return datetime_as_epoch(last_refreshed_on)
             
     # Return a fallback value
     return datetime_as_epoch(datetime.utcnow())
@@ -6,9 +6,9 @@ Copyright (c) 2013—2015 Andrea Peltrin
 Portions are copyright (c) 2013 Rui Carmo
 License: MIT (see LICENSE for details)
 """
-import os
+import os, json, base64
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import wraps, partial
 from webob import Request, Response
 from webob.exc import *
 from tempita import Template
@@ -27,6 +27,10 @@ from plugins import trigger_event, load_plugins
 
 ENTRIES_PER_PAGE    = 30
 FEEDS_PER_PAGE      = 60
+# Newest first, id tells apart entries updated at the same time
+ENTRIES_ORDER       = Entry.last_updated_on.desc(), Entry.id.desc()
+CURSOR_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+ICON_MAX_AGE        = 365*24*3600 # Seconds
 USER_SESSION_KEY    = 'FrontendApp.user'
 COOKIE_SESSION_KEY  = '_SID_'
 
@@ -57,49 +61,53 @@ class FrontendApp(WSGIApp, FeedController, UserController):
             filter = getattr(filters, name)
             self.app_namespace[filter.name] = filter
 
-    def _make_view_variables(self): 
+    def _make_view_variables(self, with_count=True): 
         
         count, group_id, feed_id, filter_name, filter_class, panel_title, page_title = 0, 0, 0, '', '', '', ''
         
         groups = self.get_groups()    
-        r = Entry.select(Entry.id).join(Read).where((Read.user == self.user)).naive()
-        s = Entry.select(Entry.id).join(Saved).where((Saved.user == self.user)).naive()
-        read_ids    = dict((i.id, None) for i in r)
-        saved_ids   = dict((i.id, None) for i in s)
-        
+
         if 'saved' in self.request.GET:
-            count, q = self.get_saved_entries(Entry.id).count(), self.get_saved_entries()
+            count_entries = self.get_saved_entries(Entry.id).count
+            q = self.get_saved_entries()
             panel_title = 'Saved'
             filter_class = filter_name = 'saved'
             page_title = 'Saved'
         elif 'group' in self.request.GET:
             group_id = int(self.request.GET['group'])    
             group = Group.get(Group.id == group_id) 
-            count, q = self.get_group_entries(group, Entry.id).count(), self.get_group_entries(group)
+            count_entries = partial(self.count_feed_entries, FeedCounter.total, FeedCounter.feed << self.get_group_feeds(group).select(Feed.id))
+            q = self.get_group_entries(group)
             panel_title = group.title                
             filter_name = 'group=%s' % group_id
             page_title = group.title
         elif 'feed' in self.request.GET:
             feed_id = int(self.request.GET['feed'])
             feed = Feed.get(Feed.id == feed_id) 
-            count, q = self.get_feed_entries(feed, Entry.id).count(), self.get_feed_entries(feed)
+            count_entries = partial(self.count_feed_entries, FeedCounter.total, FeedCounter.feed == feed)
+            q = self.get_feed_entries(feed)
             panel_title = feed.title
             filter_class = 'feeds'
             filter_name = 'feed=%s' % feed_id
             page_title = feed.title
         elif 'all' in self.request.GET:
-            count, q = self.get_all_entries(Entry.id).count(), self.get_all_entries()
+            count_entries = partial(self.count_feed_entries, FeedCounter.total)
+            q = self.get_all_entries()
             panel_title = 'All'                
             filter_class = filter_name = 'all'
             page_title = 'All'
         else: # Default
-            count, q = self.get_unread_entries(Entry.id).count(), self.get_unread_entries()
+            count_entries = partial(self.count_feed_entries, FeedCounter.unread)
+            q = self.get_unread_entries()
             panel_title = 'Unread'
             filter_class = filter_name = 'unread'
             page_title = 'Unread'
+
+        if with_count:
+            count = count_entries()
                     
         # Cleanup namespace
-        del r, s, self
+        del count_entries, with_count, self
         
         return q, locals()
                         
@@ -122,13 +130,16 @@ class FrontendApp(WSGIApp, FeedController, UserController):
 
         self.mark_entry(entry, 'read')                                
 
-        q, namespace = self._make_view_variables()
-        n = q.where(Entry.last_updated_on < entry.last_updated_on).order_by(Entry.last_updated_on.desc()).limit(1)
+        q, namespace = self._make_view_variables(with_count=False)
+        n = list(q.where(_entries_after(entry.last_updated_on, entry.id)).order_by(*ENTRIES_ORDER).limit(1))
+        read_ids, saved_ids = self.get_entry_status([entry.id] + [e.id for e in n])
 
         namespace.update({
             'entry': entry,
             'page_title': entry.title,
             'next_entries': n,            
+            'read_ids': read_ids,
+            'saved_ids': saved_ids,
             'count': 0 # Fake it
         })
 
@@ -163,12 +174,30 @@ class FrontendApp(WSGIApp, FeedController, UserController):
         '''
         q, namespace = self._make_view_variables()
 
-        offset = int(self.request.GET.get('offset', 0))            
-        entries = q.order_by(Entry.last_updated_on.desc()).offset(offset).limit(ENTRIES_PER_PAGE)
+        if 'cursor' in self.request.GET:
+            last_updated_on, entry_id = _parse_cursor(self.request.GET['cursor'])
+            try:
+                last_updated_on = datetime.strptime(last_updated_on, CURSOR_DATETIME_FORMAT)
+            except (TypeError, ValueError):
+                raise HTTPBadRequest('Invalid cursor')
+            q = q.where(_entries_after(last_updated_on, entry_id))
+
+        # Seek past previous page instead of skipping its rows
+        entries = list(q.order_by(*ENTRIES_ORDER).limit(ENTRIES_PER_PAGE + 1))
+        cursor = None
+        if len(entries) > ENTRIES_PER_PAGE:
+            entries = entries[:ENTRIES_PER_PAGE]
+            last = entries[-1]
+            cursor = _make_cursor(last.last_updated_on.strftime(CURSOR_DATETIME_FORMAT), last.id)
+
+        # Look up status of rendered entries only
+        read_ids, saved_ids = self.get_entry_status([e.id for e in entries])
         
         namespace.update({
-            'entries'   : q.order_by(Entry.last_updated_on.desc()).offset(offset).limit(ENTRIES_PER_PAGE),
-            'offset'    : offset + ENTRIES_PER_PAGE,
+            'entries'   : entries,
+            'read_ids'  : read_ids,
+            'saved_ids' : saved_ids,
+            'cursor'    : cursor,
             'prev_date' : self.request.GET.get('prev_date', None),
             #'count'     : count
         })
@@ -200,37 +229,16 @@ class FrontendApp(WSGIApp, FeedController, UserController):
             except Feed.DoesNotExist:
                 raise HTTPNotFound('No such feed %s' % feed_id)
             
-            q = Entry.select(Entry).join(Feed).join(Subscription).where(
-                (Subscription.user == self.user) &            
-                # Exclude entries already marked as read
-                ~(Entry.id << Read.select(Read.entry).where(Read.user == self.user)) &
-                # Filter by current feed
-                (Entry.feed == feed) &
-                # Exclude entries fetched after the page load                
-                (Feed.last_checked_on < before) 
-            ).distinct()
+            # Exclude entries fetched after the page load                
+            self.mark_entries_read(Entry.feed == feed, Feed.last_checked_on < before)
             message = 'SUCCESS Feed has been marked as read'
             redirect_url = '%s/entries/?feed=%s' % (self.application_url, feed_id)
         else:
-            q = Entry.select(Entry).join(Feed).join(Subscription).where(
-                (Subscription.user == self.user) &            
-                # Exclude entries already marked as read
-                ~(Entry.id << Read.select(Read.entry).where(Read.user == self.user)) &
-                # Exclude entries fetched after the page load
-                (Feed.last_checked_on < before) 
-            ).distinct()
+            # Exclude entries fetched after the page load
+            self.mark_entries_read(Feed.last_checked_on < before)
             message = 'SUCCESS All entries have been marked as read'
             redirect_url = '%s/entries/?unread' % self.application_url
         
-        #@@TODO: Use insert_many()
-        with transaction():
-            for entry in q:
-                try:
-                    Read.create(user=self.user, entry=entry)
-                except IntegrityError:
-                    logger.debug(u'entry %d already marked as read, ignored' % entry.id)
-                    continue                     
-        
         self.alert_message = message        
         return self.respond_with_script('_modal_done.js', {'location': redirect_url})
                                 
@@ -242,14 +250,24 @@ class FrontendApp(WSGIApp, FeedController, UserController):
         '''
         Show subscribed feeds for current user
         '''
-        offset, group_id, feed_id, filter_class, panel_title, page_title = 0, 0, 0, 'feeds', 'Feeds', 'Feeds'
+        group_id, feed_id, filter_class, panel_title, page_title = 0, 0, 'feeds', 'Feeds', 'Feeds'
 
         max_errors = config.fetcher.max_errors
         groups = self.get_groups()  
-        offset = int(self.request.GET.get('offset', 0))
         count, q = self.get_feeds(Feed.id).count(), self.get_feeds()
-        feeds = q.order_by(Feed.title).offset(offset).limit(FEEDS_PER_PAGE)
-        offset += FEEDS_PER_PAGE
+
+        # Feeds could miss a title until first fetched
+        title = fn.COALESCE(Feed.title, '')
+        if 'cursor' in self.request.GET:
+            last_title, last_id = _parse_cursor(self.request.GET['cursor'])
+            q = q.where((title > last_title) | ((title == last_title) & (Feed.id > last_id)))
+
+        feeds = list(q.order_by(title, Feed.id).limit(FEEDS_PER_PAGE + 1))
+        cursor = None
+        if len(feeds) > FEEDS_PER_PAGE:
+            feeds = feeds[:FEEDS_PER_PAGE]
+            cursor = _make_cursor(feeds[-1].title or '', feeds[-1].id)
+        del title
         
         return self.respond_with_template('feeds.html', locals())  
 
@@ -281,6 +299,8 @@ class FrontendApp(WSGIApp, FeedController, UserController):
             return self.respond_with_template('_feed_edit.html', locals())
         feed.title = title
         feed.save()
+        # Title is shown to every subscriber
+        Revision.bump(Subscription.select(Subscription.user).where(Subscription.feed == feed), 'subscriptions')
         self.alert_message = u'SUCCESS Changes have been saved.'
         return self.respond_with_script('_modal_done.js', {'location': '%s/feeds/' % self.application_url}) 
 
@@ -299,7 +319,7 @@ class FrontendApp(WSGIApp, FeedController, UserController):
                 title=u'Remove <i>%s</i> from your subscriptions?' % feed.title, button='Remove')
 
         # Handle postback
-        Subscription.delete().where((Subscription.user == self.user) & (Subscription.feed == feed)).execute()
+        self.remove_subscription(feed)
         self.alert_message = u'SUCCESS You are no longer subscribed to <i>%s</i>.' % feed.title  
 
         return self.redirect_after_post('%s/feeds/' % self.application_url)
@@ -323,7 +343,7 @@ class FrontendApp(WSGIApp, FeedController, UserController):
                 button='Enable')
         
         # Handle postback
-        feed.is_enabled, feed.error_count  = True, 0
+        feed.is_enabled, feed.error_count, feed.next_check_on = True, 0, datetime.utcnow()
         feed.save()
         self.alert_message = u'SUCCESS Feed <i>%s</i> is now enabled.' % feed.title  
 
@@ -372,6 +392,8 @@ class FrontendApp(WSGIApp, FeedController, UserController):
         logger.debug(u"starting fetcher")
         trigger_event('fetch_started')        
         Fetcher(feed).update_feed_with_data(response.text)        
+        # Let other subscribers know about new entries
+        set_last_refreshed_on(datetime.utcnow())
         trigger_event('fetch_done', [feed])
         
         return self._add_subscription(feed, group_id)
@@ -418,8 +440,29 @@ class FrontendApp(WSGIApp, FeedController, UserController):
         return self.respond_with_script('_modal_done.js', {'location': '%s/?feed=%d' % (self.application_url, feed.id)})     
     
 
+    # Icons
+
+    @GET(r'^/icons/(\d+)$')
+    @login_required
+    def icon(self, icon_id):
+        '''
+        Serve a feed icon, id 0 being the default one
+        '''
+        try:
+            icon = Icon.get(Icon.id == icon_id) if int(icon_id) else Icon(data=Feed.DEFAULT_ICON)
+        except Icon.DoesNotExist:
+            raise HTTPNotFound('No such icon %s' % icon_id)
+
+        content_type, data = parse_data_uri(icon.data)
+        response = Response(data, content_type=content_type, conditional_response=True)
+        # Icons are stored by content, hence never change
+        response.cache_control.private = True
+        response.cache_control.max_age = ICON_MAX_AGE
+        response.etag = icon.data_hash or make_sha1_hash(icon.data)
+        return response
+
     @GET(r'^/fever/?$')
-    def fever(self):        
+    def fever(self):
         page_title = 'Fever Endpoint'
         return self.respond_with_template('fever.html')
 
@@ -581,12 +624,35 @@ class FrontendApp(WSGIApp, FeedController, UserController):
 
 
 def setup_app():
+    if config.web.preload_templates:
+        template_cache.preload(template_dir, Template)
     return SessionMiddleware(FrontendApp(), fieldname=COOKIE_SESSION_KEY)
 
               
 #@@TODO: use utilities.render_template - see http://bit.ly/P5Hh5m
 def _render_template(filename, namespace):                    
-    return Template.from_filename(os.path.join(template_dir, filename), namespace=namespace).substitute()
+    return template_cache.get(os.path.join(template_dir, filename), Template).substitute(namespace)
+
+# Pagination
+
+def _entries_after(last_updated_on, entry_id):
+    # First term bounds an index range scan
+    return (Entry.last_updated_on <= last_updated_on) & (
+        (Entry.last_updated_on < last_updated_on) | (Entry.id < entry_id))
+
+def _make_cursor(*values):
+    '''
+    Encode sort values of the last listed row as an opaque string
+    '''
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+def _parse_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        value, row_id = values
+        return value, int(row_id)
+    except (TypeError, ValueError):
+        raise HTTPBadRequest('Invalid cursor')
 
 # Stats
 
@@ -597,7 +663,7 @@ def get_stats():
     
     now = datetime.utcnow()
     
-    last_checked_on = Feed.select().aggregate(fn.Max(Feed.last_checked_on))
+    last_checked_on = get_last_refreshed_on()
     if last_checked_on:
         last_checked_on = format_datetime(last_checked_on)
     else:
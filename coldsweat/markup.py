@@ -183,6 +183,23 @@ class FeedLinkFinder(BaseParser):
         url, title = urlparse.urljoin(self.base_url, d['href']), d['title'] if 'title' in d else u''
         self.links.append((url, title))
 
+class IconLinkFinder(FeedLinkFinder):
+    '''
+    Find the favicons for a web page
+    '''
+
+    def start_link(self, attrs):                
+        d = dict(_normalize_attrs(attrs))
+        if 'rel' not in d: 
+            return
+        # Match both rel="icon" and older rel="shortcut icon"
+        if 'icon' not in d['rel'].split():
+            return
+        if 'href' not in d:
+            return
+
+        self.links.append(urlparse.urljoin(self.base_url, d['href']))
+
  
 class Scrubber(BaseProcessor):
     '''
@@ -249,6 +266,14 @@ def find_feed_links(data, base_url=''):
     _parse(p, data)
     return p.links
 
+def find_icon_links(data, base_url=''):
+    '''
+    Return the favicon links found for the page
+    '''
+    p = IconLinkFinder(base_url)
+    _parse(p, data)
+    return p.links
+
 def sniff_feed(data): 
     data = data.lower()
     if data.count('<html'):
@@ -8,10 +8,14 @@ License: MIT (see LICENSE for details)
 """
 import urlparse 
 import pickle
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 from peewee import *
+from peewee import SelectQuery
 from playhouse.migrate import *
-from playhouse.signals import Model as BaseModel, pre_save
+from playhouse.signals import Model as BaseModel, pre_save, post_save
 from playhouse.reflection import Introspector
 from webob.exc import status_map
 
@@ -21,19 +25,34 @@ from utilities import *
 __all__ = [
     'User',
     'Group',
+    'Icon',
     'Feed',
+    'Favicon',
     'Entry',
     'Read',
+    'Unread',
     'Saved',
     'Subscription',
+    'FeedCounter',
+    'Revision',
+    'Metadata',
     'Session',
     'connect',
     'close',
     'transaction',
+    'insert_or_ignore',
+    'chunked',
+    'PARAMS_PER_QUERY',
+    'explain',
+    'get_last_refreshed_on',
+    'set_last_refreshed_on',
     'setup_database_schema',
     'migrate_database_schema',
 ]
 
+# Stay below SQLite limit of 999 parameters per query
+PARAMS_PER_QUERY = 500
+
 # Feed default icon
 _ICON = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAABAAAAAQCAYAAAA\
 f8/9hAAAAGXRFWHRTb2Z0d2FyZQBBZG9iZSBJbWFnZVJlYWR5ccllPAAAAUtJREFUeNqk\
@@ -127,13 +146,21 @@ class User(CustomModel):
 
     @staticmethod
     def validate_api_key(api_key):
+        # Clients may send api_key in uppercase, lower it
+        api_key = api_key.lower()
+        user = api_key_cache.get(api_key)
+        if user:
+            return user
+
         try:
-            # Clients may send api_key in uppercase, lower it
-            user = User.get((User.api_key == api_key.lower()) & 
+            user = User.get((User.api_key == api_key) & 
                 (User.is_enabled == True))        
         except User.DoesNotExist:
             return None
 
+        api_key_cache.set(api_key, user)
+        logger.debug(u'validated API key for user %s (%d cache hits, %d misses)' % (
+            user.username, api_key_cache.hit_count, api_key_cache.miss_count))
         return user
 
     @staticmethod
@@ -159,10 +186,51 @@ class User(CustomModel):
 @pre_save(sender=User)
 def on_user_save(model, user, created):
      user.api_key = User.make_api_key(user.email, user.password)
+     # Key or enabled status could be changing
+     api_key_cache.remove_user(user.id)
+
+
+class ApiKeyCache(object):
+    '''
+    Users of recently validated API keys, kept for a limited time
+    '''
+
+    def __init__(self, max_age, max_size):
+        self.max_age, self.max_size = max_age, max_size
+        self.hit_count, self.miss_count = 0, 0
+        self._users = OrderedDict() # api_key -> (user, expires_on)
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        with self._lock:
+            user, expires_on = self._users.get(api_key, (None, 0))
+            if user and expires_on > time.time():
+                self.hit_count += 1
+                return user
+            self.miss_count += 1
+            return None
+
+    def set(self, api_key, user):
+        if not (self.max_age and self.max_size):
+            return
+        with self._lock:
+            self._users.pop(api_key, None)
+            while len(self._users) >= self.max_size:
+                # Evict the least recently validated key
+                self._users.popitem(last=False)
+            self._users[api_key] = user, time.time() + self.max_age
+
+    def remove_user(self, user_id):
+        with self._lock:
+            for api_key, (user, expires_on) in self._users.items():
+                if user.id == user_id:
+                    del self._users[api_key]
+
+api_key_cache = ApiKeyCache(config.web.api_key_cache_ttl, config.web.api_key_cache_size)
           
 
 #@@REMOVEME: We keep this only to make migrations work
-class Icon(CustomModel):
+class LegacyIcon(CustomModel):
     """
     Feed (fav)icons, stored as data URIs
     """
@@ -170,6 +238,26 @@ class Icon(CustomModel):
 
     class Meta:
         db_table = 'icons'
+
+
+class Icon(CustomModel):
+    """
+    Feed (fav)icons, stored once for each distinct image
+    """
+    data                 = TextField()                          # Stored as data URI
+    data_hash            = CharField(unique=True, max_length=40)
+
+    class Meta:
+        db_table = 'feed_icons'
+
+    @staticmethod
+    def store(data):
+        '''
+        Return the icon id for given data URI, saving it if new
+        '''
+        data_hash = make_sha1_hash(data)
+        return upsert(lambda: Icon.select(Icon.id).where(Icon.data_hash == data_hash).first(),
+            lambda: Icon.create(data=data, data_hash=data_hash)).id
       
 
 class Group(CustomModel):
@@ -203,14 +291,21 @@ class Feed(CustomModel):
     title                = CharField(null=True)        
     alternate_link       = TextField(null=True)                 # The URL of the HTML page associated with the feed (rel=alternate)
     etag                 = CharField(null=True)                 # HTTP E-tag
+    content_hash         = CharField(null=True, max_length=40)  # Last response body hash
     last_updated_on      = DateTimeField(null=True)             # As UTC
     last_checked_on      = DateTimeField(index=True, null=True) # As UTC 
     last_status          = IntegerField(null=True)              # Last returned HTTP code    
 
-    icon                 = TextField(null=True)                 # Stored as data URI
+    icon                 = ForeignKeyField(Icon, null=True)
     icon_last_updated_on = DateTimeField(null=True)             # As UTC
 
+    next_check_on        = DateTimeField(default=datetime.utcnow) # As UTC
+
     class Meta:
+        indexes = (
+            # Find out which feeds are due for fetching
+            (('is_enabled', 'next_check_on'), False),
+        )
         db_table = 'feeds'
 
     @property
@@ -220,13 +315,21 @@ class Feed(CustomModel):
             return datetime_as_epoch(self.last_updated_on)
         return 0 
 
-    @property
-    def icon_or_default(self):
-        return self.icon if self.icon else Feed.DEFAULT_ICON
-
 @pre_save(sender=Feed)
 def on_feed_save(model, feed, created):
      feed.self_link_hash = make_sha1_hash(feed.self_link)       
+
+
+class Favicon(CustomModel):
+    """
+    Site (fav)icons shared by feeds on the same domain
+    """
+    domain               = CharField(unique=True)
+    icon                 = ForeignKeyField(Icon)
+    last_updated_on      = DateTimeField()                      # As UTC
+
+    class Meta:
+        db_table = 'favicons'
       
         
 class Entry(CustomModel):
@@ -251,6 +354,11 @@ class Entry(CustomModel):
     link                = TextField(null=True)                  # If null the entry *must* provide a GUID
     
     class Meta:
+        indexes = (
+            # Seek entry lists, newest first
+            (('last_updated_on', 'id'), False),
+            (('feed', 'last_updated_on', 'id'), False),
+        )
         db_table = 'entries'
 
     @property
@@ -287,9 +395,37 @@ class Read(CustomModel):
     class Meta:
         indexes = (
             (('user', 'entry'), True),
+            # Recently read entries
+            (('user', 'read_on'), False),
         )
 
 
+@post_save(sender=Read)
+def on_read_save(model, read, created):
+    if Unread.delete().where((Unread.user == read.user_id) & (Unread.entry == read.entry_id)).execute():
+        FeedCounter.add_unread(read.user_id, read.entry_id, -1)
+
+
+class Unread(CustomModel):
+    """
+    Entries of subscribed feeds not marked as read yet, kept 
+      along with Read and Subscription rows
+    """
+    user           = ForeignKeyField(User)
+    entry          = ForeignKeyField(Entry, on_delete='CASCADE')    
+
+    class Meta:
+        indexes = (
+            (('user', 'entry'), True),
+        )
+
+
+@post_save(sender=Unread)
+def on_unread_save(model, unread, created):
+    if created:
+        FeedCounter.add_unread(unread.user_id, unread.entry_id, 1)
+
+
 class Subscription(CustomModel):
     """
     A user's feed subscription
@@ -301,10 +437,128 @@ class Subscription(CustomModel):
     class Meta:
         indexes = (
             (('user', 'group', 'feed'), True),
+            # Check if an entry belongs to user's feeds
+            (('user', 'feed'), False),
         )    
         db_table = 'subscriptions'
 
 
+class FeedCounter(CustomModel):
+    """
+    Total and unread entries of a feed subscribed by a user, kept 
+      along with Entry, Unread and Subscription rows
+    """
+    user            = ForeignKeyField(User, on_delete='CASCADE')
+    feed            = ForeignKeyField(Feed, on_delete='CASCADE')
+    total           = IntegerField(default=0)
+    unread          = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('user', 'feed'), True),
+        )
+        db_table = 'feed_counters'
+
+    @staticmethod
+    def count(user, feed=None):
+        '''
+        Count total and unread entries of user feeds, return 
+          a dict of (total, unread) tuples by feed id
+        '''
+        feeds = Subscription.select(Subscription.feed).where(Subscription.user == user)
+        if feed:
+            feeds = feeds.where(Subscription.feed == feed)
+        counts = dict((feed_id, (0, 0)) for feed_id, in feeds.distinct().tuples())
+        if not counts:
+            return counts
+
+        q = Entry.select(Entry.feed, fn.Count(Entry.id)).where(Entry.feed << feeds).group_by(Entry.feed)
+        for feed_id, total in q.tuples():
+            counts[feed_id] = total, 0
+        q = Unread.select(Entry.feed, fn.Count(Unread.id)).join(Entry).where(
+            (Unread.user == user) & (Entry.feed << feeds)).group_by(Entry.feed)
+        for feed_id, unread in q.tuples():
+            counts[feed_id] = counts[feed_id][0], unread
+        return counts
+
+    @staticmethod
+    def store(user, feed_id, total, unread):
+        upsert(lambda: FeedCounter.update(total=total, unread=unread).where(
+                (FeedCounter.user == user) & (FeedCounter.feed == feed_id)).execute(),
+            lambda: FeedCounter.create(user=user, feed=feed_id, total=total, unread=unread))
+
+    @staticmethod
+    def add_unread(user, entries, value):
+        '''
+        Add value to unread count of the feeds of given 
+          entry or entries selected by a query
+        '''
+        if isinstance(entries, SelectQuery):
+            # One update for each feed
+            q = Entry.select(Entry.feed, fn.Count(Entry.id)).where(Entry.id << entries).group_by(Entry.feed)
+            for feed_id, count in q.tuples():
+                FeedCounter.update(unread=FeedCounter.unread + value * count).where(
+                    (FeedCounter.user == user) & (FeedCounter.feed == feed_id)).execute()
+        else:
+            FeedCounter.update(unread=FeedCounter.unread + value).where((FeedCounter.user == user) & 
+                (FeedCounter.feed << Entry.select(Entry.feed).where(Entry.id == entries))).execute()
+
+
+class Revision(CustomModel):
+    """
+    Per-user counters bumped whenever subscriptions, unread 
+      or saved entries of user change
+    """
+    user            = ForeignKeyField(User, unique=True, on_delete='CASCADE')
+    subscriptions   = IntegerField(default=0)
+    unread          = IntegerField(default=0)
+    saved           = IntegerField(default=0)
+
+    class Meta:
+        db_table = 'revisions'
+
+    @staticmethod
+    def get_or_create(user):
+        return upsert(lambda: Revision.select().where(Revision.user == user).first(),
+            lambda: Revision.create(user=user))
+
+    @staticmethod
+    def bump(user, *names):
+        '''
+        Increment given counters of user, or of the users selected by 
+          a query. Rows are created when first read, so a missing 
+          one has never been handed out to clients
+        '''
+        where = (Revision.user << user) if isinstance(user, SelectQuery) else (Revision.user == user)
+        values = dict((name, getattr(Revision, name) + 1) for name in names)
+        Revision.update(**values).where(where).execute()
+
+
+class Metadata(CustomModel):
+    """
+    Named values about the whole installation
+    """
+    LAST_REFRESHED_ON = 'last_refreshed_on' # As UTC epoch 
+
+    name            = CharField(unique=True)
+    value           = TextField()
+
+    class Meta:
+        db_table = 'metadata'
+
+    @staticmethod
+    def get_value(name, default=None):
+        try:
+            return Metadata.select(Metadata.value).where(Metadata.name == name).get().value
+        except Metadata.DoesNotExist:
+            return default
+
+    @staticmethod
+    def set_value(name, value):
+        upsert(lambda: Metadata.update(value=value).where(Metadata.name == name).execute(),
+            lambda: Metadata.create(name=name, value=value))
+
+
 class Session(CustomModel):
     """
     Web session
@@ -328,6 +582,64 @@ def connect():
 def transaction():
     return _db.transaction()
 
+def upsert(lookup, create):
+    '''
+    Call lookup, which selects or updates a row, and create the row if 
+      it finds nothing. Return what lookup or create returned
+    '''
+    result = lookup()
+    if result:
+        return result
+    try:
+        return create()
+    except IntegrityError:
+        # Created meanwhile by another process
+        return lookup()
+
+def insert_or_ignore(query):
+    '''
+    Run an INSERT query skipping rows which would violate a unique 
+      constraint, return the number of inserted rows
+    '''
+    sql, params = query.sql()
+    if engine == 'sqlite':
+        sql = sql.replace('INSERT INTO', 'INSERT OR IGNORE INTO', 1)
+    elif engine == 'mysql':
+        sql = sql.replace('INSERT INTO', 'INSERT IGNORE INTO', 1)
+    else: # PostgreSQL 9.5 and up
+        sql = '%s ON CONFLICT DO NOTHING' % sql
+    return _db.execute_sql(sql, params).rowcount
+
+def chunked(items, size=PARAMS_PER_QUERY):
+    '''
+    Split items in lists short enough to be passed as query parameters
+    '''
+    items = list(items)
+    for index in range(0, len(items), size):
+        yield items[index:index+size]
+
+def explain(query):
+    '''
+    Return the steps database would follow to run query
+    '''
+    sql, params = query.sql()
+    if engine == 'sqlite':
+        rows = _db.execute_sql('EXPLAIN QUERY PLAN %s' % sql, params).fetchall()
+        # Just the step detail
+        return [row[-1] for row in rows]
+    rows = _db.execute_sql('EXPLAIN %s' % sql, params).fetchall()
+    return [' | '.join(unicode(value) for value in row) for row in rows]
+
+def get_last_refreshed_on():
+    '''
+    Time the last feeds refresh completed or None
+    '''
+    value = Metadata.get_value(Metadata.LAST_REFRESHED_ON)
+    return datetime.utcfromtimestamp(int(value)) if value else None
+
+def set_last_refreshed_on(value):
+    Metadata.set_value(Metadata.LAST_REFRESHED_ON, datetime_as_epoch(value))
+
 def close():
     logger.debug('closing connection')
     if not _db.is_closed():
@@ -342,8 +654,10 @@ def migrate_database_schema():
     models = introspector.generate_models()
     Feed_ = models['feeds']
     Entry_ = models['entries']
+    # Columns found before any migration runs
+    feed_columns = [column.name for column in _db.get_columns('feeds')]
 
-    drop_table_migrations, column_migrations = [], []
+    create_table_migrations, drop_table_migrations, column_migrations = [], [], []
     
     # --------------------------------------------------------------------------
     # Schema changes introduced in version 0.9.4
@@ -351,11 +665,11 @@ def migrate_database_schema():
     
     # Change columns
 
-    if hasattr(Feed_, 'icon_id'):
+    if 'icon_id' in feed_columns and LegacyIcon.table_exists():
         column_migrations.append(migrator.drop_column('feeds', 'icon_id'))
 
     if not hasattr(Feed_, 'icon'):
-        column_migrations.append(migrator.add_column('feeds', 'icon', Feed.icon))
+        column_migrations.append(migrator.add_column('feeds', 'icon', TextField(null=True)))
 
     if not hasattr(Feed_, 'icon_last_updated_on'):
         column_migrations.append(migrator.add_column('feeds', 'icon_last_updated_on', Feed.icon_last_updated_on))
@@ -365,8 +679,8 @@ def migrate_database_schema():
 
     # Drop tables
 
-    if Icon.table_exists():
-        drop_table_migrations.append(Icon.drop_table)
+    if LegacyIcon.table_exists():
+        drop_table_migrations.append(LegacyIcon.drop_table)
 
     # --------------------------------------------------------------------------
     # Schema changes introduced in version 0.9.5
@@ -420,20 +734,124 @@ def migrate_database_schema():
     # Misc.
         
     column_migrations.append(UpdateUserApiKeyOperation())
+
+    # --------------------------------------------------------------------------
+    # Schema changes introduced in version 0.9.7
+    # --------------------------------------------------------------------------
+
+    # Change columns
+
+    if not hasattr(Feed_, 'next_check_on'):
+        column_migrations.append(migrator.add_column('feeds', 'next_check_on', Feed.next_check_on))
+        column_migrations.append(migrator.add_index('feeds', ('is_enabled', 'next_check_on'), False))
+
+    if not hasattr(Feed_, 'content_hash'):
+        column_migrations.append(migrator.add_column('feeds', 'content_hash', Feed.content_hash))
+
+    class MoveFeedIconsOperation(object):
+        # Store each distinct icon once and make feeds reference it
+        def run(self):        
+            for feed_id, data in _db.execute_sql('SELECT id, icon FROM feeds WHERE icon IS NOT NULL').fetchall():
+                Feed.update(icon=Icon.store(data)).where(Feed.id == feed_id).execute()
+
+    # A legacy icon_id has been dropped above
+    if LegacyIcon.table_exists() or 'icon_id' not in feed_columns:
+        column_migrations.append(migrator.add_column('feeds', 'icon_id', Feed.icon))
+        column_migrations.append(migrator.add_index('feeds', ('icon_id',), False))
+        if 'icon' in feed_columns:
+            column_migrations.append(MoveFeedIconsOperation())
+            column_migrations.append(migrator.drop_column('feeds', 'icon'))
+
+    # Add indices
+
+    entry_indexes = [index.name for index in _db.get_indexes('entries')]
+    if 'entries_last_updated_on_id' not in entry_indexes:
+        column_migrations.append(migrator.add_index('entries', ('last_updated_on', 'id'), False))
+    if 'entries_feed_id_last_updated_on_id' not in entry_indexes:
+        column_migrations.append(migrator.add_index('entries', ('feed_id', 'last_updated_on', 'id'), False))
+
+    read_indexes = [index.name for index in _db.get_indexes('read')]
+    if 'read_user_id_read_on' not in read_indexes:
+        column_migrations.append(migrator.add_index('read', ('user_id', 'read_on'), False))
+
+    subscription_indexes = [index.name for index in _db.get_indexes('subscriptions')]
+    if 'subscriptions_user_id_feed_id' not in subscription_indexes:
+        column_migrations.append(migrator.add_index('subscriptions', ('user_id', 'feed_id'), False))
+
+    class PopulateUnreadOperation(object):
+        # Entries of subscribed feeds not marked as read yet
+        def run(self):        
+            q = Subscription.select(Subscription.user, Entry.id).join(Entry, on=(Subscription.feed == Entry.feed)).where(
+                ~fn.EXISTS(Read.select(SQL('1')).where((Read.user == Subscription.user) & (Read.entry == Entry.id)))).distinct()
+            Unread.insert_from([Unread.user, Unread.entry], q).execute()
+
+    if not Unread.table_exists():
+        column_migrations.append(PopulateUnreadOperation())
+
+    class PopulateMetadataOperation(object):
+        # Feeds refresh predates metadata
+        def run(self):        
+            last_checked_on = Feed.select().aggregate(fn.Max(Feed.last_checked_on))
+            if last_checked_on:
+                set_last_refreshed_on(last_checked_on)
+
+    if not Metadata.table_exists():
+        column_migrations.append(PopulateMetadataOperation())
+
+    class PopulateFeedCountersOperation(object):
+        # Count entries once, then keep counters updated
+        def run(self):        
+            for user in User.select(User.id):
+                for feed_id, (total, unread) in FeedCounter.count(user).items():
+                    FeedCounter.store(user, feed_id, total, unread)
+
+    if not FeedCounter.table_exists():
+        column_migrations.append(PopulateFeedCountersOperation())
+
+    # Create tables
+
+    if not Icon.table_exists():
+        create_table_migrations.append(Icon.create_table)
+
+    if not Favicon.table_exists():
+        create_table_migrations.append(Favicon.create_table)
+
+    if not Unread.table_exists():
+        create_table_migrations.append(Unread.create_table)
+
+    if not Revision.table_exists():
+        create_table_migrations.append(Revision.create_table)
+
+    if not Metadata.table_exists():
+        create_table_migrations.append(Metadata.create_table)
+
+    if not FeedCounter.table_exists():
+        create_table_migrations.append(FeedCounter.create_table)
         
     # --------------------------------------------------------------------------
     
     # Run all table and column migrations
 
+    for create in create_table_migrations:
+        create()
+
     if column_migrations:
-        # Let caller to catch any OperationalError's
-        migrate(*column_migrations)        
+        # SQLite alters some columns by recreating the whole table, do not
+        #   let it cascade delete rows referencing the old one
+        if engine == 'sqlite':
+            _db.execute_sql('PRAGMA foreign_keys=OFF;')
+        try:
+            # Let caller to catch any OperationalError's
+            migrate(*column_migrations)        
+        finally:
+            if engine == 'sqlite':
+                _db.execute_sql('PRAGMA foreign_keys=ON;')
 
     for drop in drop_table_migrations:
         drop()
 
     # True if at least one is non-empty
-    return drop_table_migrations or column_migrations
+    return create_table_migrations or drop_table_migrations or column_migrations
 
 
 def setup_database_schema():
@@ -441,7 +859,7 @@ def setup_database_schema():
     Create database and tables for all models and setup bootstrap data
     """
 
-    models = User, Feed, Entry, Group, Read, Saved, Subscription, Session
+    models = User, Icon, Feed, Favicon, Entry, Group, Read, Unread, Saved, Subscription, FeedCounter, Revision, Metadata, Session
 
     for model in models:
         model.create_table(fail_silently=True)
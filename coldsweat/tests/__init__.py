@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+'''
+Description: helpers shared by tests and benchmarks which need a
+  database. They run against a scratch SQLite database so the
+  configured one is never touched
+
+Copyright (c) 2013—2016 Andrea Peltrin
+License: MIT (see LICENSE for details)
+'''
+import os, shutil, tempfile
+from contextlib import contextmanager
+
+from .. import config
+
+def use_scratch_database(name):
+    '''
+    Point configuration to a new SQLite database file and return its
+      name. Must be called before models get bound to the configured
+      database, that is before importing them
+    '''
+    filename = os.path.join(tempfile.mkdtemp(), '%s.db' % name)
+    config.database.connection_url = 'sqlite:///%s' % filename
+    return filename
+
+@contextmanager
+def scratch_database(filename):
+    '''
+    Create tables in given scratch database, then remove it when done
+    '''
+    from ..models import setup_database_schema, close
+    setup_database_schema()
+    try:
+        yield
+    finally:
+        close()
+        shutil.rmtree(os.path.dirname(filename))
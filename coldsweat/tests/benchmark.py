@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Description: quick & dirty benchmarks
+
+Copyright (c) 2013—2016 Andrea Peltrin
+License: MIT (see LICENSE for details)
+'''
+import time, optparse
+from datetime import datetime, timedelta
+
+from peewee import fn, Param
+
+from . import use_scratch_database, scratch_database
+
+DATABASE_FILENAME = use_scratch_database('benchmark')
+
+from ..models import *
+from ..fetcher import Fetcher
+from ..fever import get_entries_max
+from ..utilities import make_sha1_hash, format_http_datetime
+
+ALL = 'insert items'.split()
+
+def make_feed_data(entry_count, prefix='entry'):
+    '''
+    Build an RSS document with given number of items
+    '''
+    now = datetime.utcnow()
+    items = []
+    for index in range(entry_count):
+        items.append('''<item>
+            <title>Item %(index)d</title>
+            <link>http://example.com/%(prefix)s/%(index)d</link>
+            <guid>urn:benchmark:%(prefix)s:%(index)d</guid>
+            <pubDate>%(date)s</pubDate>
+            <description>&lt;p&gt;Lorem ipsum dolor sit amet %(index)d&lt;/p&gt;</description>
+        </item>''' % {'index': index, 'prefix': prefix, 'date': format_http_datetime(now - timedelta(minutes=index))})
+    return '''<?xml version="1.0"?>
+        <rss version="2.0"><channel><title>Benchmark</title><link>http://example.com/</link>%s</channel></rss>''' % ''.join(items)
+
+def timed(label, count, func, unit='entries'):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print '%-40s %6d %s in %.3fs (%.0f %s/s)' % (label, count, unit, elapsed, count / elapsed, unit)
+
+def benchmark_insert(entry_count=200):
+    '''
+    Save a feed with many new items, one entry at time versus all at once
+    '''
+
+    def save_one_at_time():
+        # How fetcher used to save entries: a lookup and an autocommit insert each
+        feed = Feed.create(self_link='http://example.com/one-at-time.xml')
+        fetcher = Fetcher(feed)
+        fetcher._parse_feed(make_feed_data(entry_count, prefix='one-at-time'))
+        for entry in fetcher.entries:
+            try:
+                Entry.get(guid_hash=make_sha1_hash(entry.guid))
+                continue
+            except Entry.DoesNotExist:
+                pass
+            entry.save()
+        feed.save()
+
+    def save_all_at_once():
+        feed = Feed.create(self_link='http://example.com/all-at-once.xml')
+        Fetcher(feed).update_feed_with_data(make_feed_data(entry_count, prefix='all-at-once'))
+
+    timed('insert (one at time, before)', entry_count, save_one_at_time)
+    timed('insert (single transaction, after)', entry_count, save_all_at_once)
+
+    assert Entry.select().count() == entry_count * 2
+
+def benchmark_items(entry_count=100000, call_count=5):
+    '''
+    Serve Fever items pages for a user who has read a lot of entries
+    '''
+    user = User.create(username='benchmark', email='benchmark@example.com', password='benchmark')
+    feed = Feed.create(self_link='http://example.com/items.xml')
+    Subscription.create(user=user, feed=feed, group=Group.get(Group.title == Group.DEFAULT_GROUP))
+
+    now = datetime.utcnow()
+    with transaction():
+        for index in range(0, entry_count, 100):
+            Entry.insert_many([{
+                'feed': feed, 
+                'guid': 'urn:benchmark:items:%d' % i, 
+                'guid_hash': make_sha1_hash('urn:benchmark:items:%d' % i),
+                'title': 'Item %d' % i, 
+                'content': 'Lorem ipsum dolor sit amet %d' % i,
+                'last_updated_on': now
+            } for i in range(index, min(index + 100, entry_count))]).execute()
+        
+        # Pretend user has read every entry
+        Read.insert_from([Read.user, Read.entry, Read.read_on], 
+            Entry.select(Param(user.id), Entry.id, Param(now)).where(Entry.feed == feed)).execute()
+
+    max_id = Entry.select(fn.Max(Entry.id)).scalar() + 1
+
+    def read_all_at_once():
+        # How items used to be annotated: with every read and saved entry id
+        for index in range(call_count):
+            q = Entry.select(Entry, Feed).join(Feed).join(Subscription).where(
+                (Subscription.user == user) & (Entry.id < max_id)).distinct().limit(50)
+            r = Entry.select(Entry.id).join(Read).where(Read.user == user).naive()
+            s = Entry.select(Entry.id).join(Saved).where(Saved.user == user).naive()
+            read_ids, saved_ids = dict((i.id, None) for i in r), dict((i.id, None) for i in s)
+            [(entry.id in read_ids, entry.id in saved_ids) for entry in q]
+
+    def read_page_only():
+        for index in range(call_count):
+            get_entries_max(user, max_id)
+
+    timed('items (all read ids, before)', call_count, read_all_at_once, unit='calls')
+    timed('items (page read ids, after)', call_count, read_page_only, unit='calls')
+
+    assert all(item['is_read'] for item in get_entries_max(user, max_id))
+
+def run_benchmarks(suites=ALL):
+    print 'Using database %s' % DATABASE_FILENAME
+    with scratch_database(DATABASE_FILENAME):
+        if 'insert' in suites:
+            benchmark_insert()
+        if 'items' in suites:
+            benchmark_items()
+
+parser = optparse.OptionParser(
+    usage='%prog [-s suite]'
+    )
+parser.add_option(
+    '-s', '--suite',
+    dest='suite',
+    help='the benchmark suite to run. Available suites are: insert, items')
+
+if __name__ == '__main__':
+
+    options, args = parser.parse_args()
+
+    suite = options.suite if options.suite else ALL
+
+    run_benchmarks(suite)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Description: check set-based mark as read against the former per-entry one
+
+Copyright (c) 2013—2016 Andrea Peltrin
+License: MIT (see LICENSE for details)
+'''
+from datetime import datetime, timedelta
+
+from peewee import IntegrityError
+
+from . import use_scratch_database, scratch_database
+
+DATABASE_FILENAME = use_scratch_database('marking')
+
+from ..models import *
+from ..controllers import UserController
+
+def setup_users(feed_count=3, entries_per_feed=20):
+    '''
+    Give two users the same subscriptions, with a feed in two groups,
+      and the same few read entries
+    '''
+    users = [User.create(username=name, email='%s@example.com' % name, password=name) for name in ('before', 'after')]
+    default_group, other_group = Group.get(Group.title == Group.DEFAULT_GROUP), Group.create(title='Other')
+
+    now = datetime.utcnow()
+    feeds = [Feed.create(self_link='http://example.com/%d.xml' % index, last_checked_on=now) for index in range(feed_count)]
+    for feed in feeds:
+        for index in range(entries_per_feed):
+            guid = 'urn:marking:%d:%d' % (feed.id, index)
+            Entry.create(feed=feed, guid=guid, title=guid, content='', last_updated_on=now - timedelta(hours=index))
+
+    for user in users:
+        controller = UserController()
+        controller.user = user
+        controller.add_subscription(feeds[0], default_group)
+        controller.add_subscription(feeds[0], other_group)
+        for feed in feeds[1:]:
+            controller.add_subscription(feed, default_group)
+        for entry in Entry.select().where(Entry.feed == feeds[0]).limit(3):
+            controller.mark_entry(entry, 'read')
+
+    return users, feeds, (default_group, other_group)
+
+def mark_read_per_entry(user, *where):
+    '''
+    How entries used to be marked as read: a query and an insert each
+    '''
+    q = Entry.select(Entry).join(Feed).join(Subscription).where(
+        (Subscription.user == user) &
+        ~(Entry.id << Read.select(Read.entry).where(Read.user == user)), *where).distinct().naive()
+    with transaction():
+        for entry in q:
+            try:
+                Read.create(user=user, entry=entry)
+            except IntegrityError:
+                continue
+
+def get_status(user):
+    read_ids = set(r.entry_id for r in Read.select(Read.entry).where(Read.user == user).naive())
+    unread_ids = set(r.entry_id for r in Unread.select(Unread.entry).where(Unread.user == user).naive())
+    return read_ids, unread_ids
+
+def check_same_status(users):
+    (read_before, unread_before), (read_after, unread_after) = [get_status(user) for user in users]
+    assert read_before == read_after
+    assert unread_before == unread_after
+    assert not read_after & unread_after
+    return len(read_after)
+
+def run_tests():
+    with scratch_database(DATABASE_FILENAME):
+        users, feeds, groups = setup_users()
+        before_user, after_user = users
+        controller = UserController()
+        controller.user = after_user
+
+        # Entries older than 5 hours
+        before = datetime.utcnow() - timedelta(hours=5)
+
+        # Feed
+        where = Entry.feed == feeds[1], Entry.last_updated_on < before
+        mark_read_per_entry(before_user, *where)
+        controller.mark_entries_read(*where)
+        print 'feed:', check_same_status(users), 'read'
+
+        # Again, nothing left to mark
+        assert controller.mark_entries_read(*where) == 0
+
+        # Group, with a feed also found in another group
+        where = Entry.feed << Subscription.select(Subscription.feed).where(
+            (Subscription.user == after_user) & (Subscription.group == groups[1])), Entry.last_updated_on < before
+        mark_read_per_entry(before_user, Subscription.group == groups[1], Entry.last_updated_on < before)
+        controller.mark_entries_read(*where)
+        print 'group:', check_same_status(users), 'read'
+
+        # All, as frontend does
+        where = Feed.last_checked_on < datetime.utcnow(),
+        mark_read_per_entry(before_user, *where)
+        controller.mark_entries_read(*where)
+        print 'all:', check_same_status(users), 'read'
+
+        assert not Unread.select().count()
+
+        # Counters were kept along, whatever the marking path
+        for user in users:
+            controller.user = user
+            assert controller.check_feed_counters() == 0
+        assert not FeedCounter.select().where(FeedCounter.unread != 0).count()
+
+        controller.remove_subscription(feeds[0])
+        assert controller.check_feed_counters() == 0
+
+if __name__ == '__main__':
+    run_tests()
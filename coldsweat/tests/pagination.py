@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Description: check Fever items and web entry list pagination and their 
+  query plans
+
+Copyright (c) 2013—2016 Andrea Peltrin
+License: MIT (see LICENSE for details)
+'''
+from datetime import datetime
+
+from . import use_scratch_database, scratch_database
+
+DATABASE_FILENAME = use_scratch_database('pagination')
+
+from ..models import *
+from ..models import _db
+from ..fever import _q_entries_min, _q_entries_max, get_entries_min, get_entries_max, ITEMS_PER_PAGE
+from ..frontend import _entries_after, ENTRIES_ORDER
+from ..controllers import UserController
+from ..utilities import make_sha1_hash
+
+def setup_entries(feed_count=4, entries_per_feed=70):
+    '''
+    Subscribe a user to some feeds, one of them in two groups,
+      while a second user gets the others
+    '''
+    user = User.create(username='pagination', email='pagination@example.com', password='pagination')
+    other_user = User.create(username='other', email='other@example.com', password='other')
+    default_group, other_group = Group.get(Group.title == Group.DEFAULT_GROUP), Group.create(title='Other')
+
+    now = datetime.utcnow()
+    feeds = [Feed.create(self_link='http://example.com/%d.xml' % index) for index in range(feed_count)]
+    for index in range(entries_per_feed):
+        # Interleave entries of all feeds
+        for feed in feeds:
+            guid = 'urn:pagination:%d:%d' % (feed.id, index)
+            Entry.create(feed=feed, guid=guid, title=guid, content='', last_updated_on=now)
+
+    Subscription.create(user=user, feed=feeds[0], group=default_group)
+    Subscription.create(user=user, feed=feeds[0], group=other_group)
+    Subscription.create(user=user, feed=feeds[1], group=default_group)
+    for feed in feeds[2:]:
+        Subscription.create(user=other_user, feed=feed, group=default_group)
+
+    expected_ids = [entry.id for entry in Entry.select(Entry.id).where(Entry.feed << feeds[:2]).order_by(Entry.id)]
+    return user, expected_ids
+
+def check_query_plan(q, index='COVERING INDEX subscriptions_user_id_feed_id'):
+    sql, params = q.sql()
+    plan = ' '.join(row[-1] for row in _db.execute_sql('EXPLAIN QUERY PLAN %s' % sql, params))
+    print plan
+    # Entries must be read in list order, stopping when page is full
+    assert 'TEMP B-TREE' not in plan
+    assert index in plan
+
+def walk_entry_list(q, page_size=30):
+    '''
+    Seek through entries like the web entry list does
+    '''
+    ids, where = [], None
+    while True:
+        page = list((q.where(where) if where else q).order_by(*ENTRIES_ORDER).limit(page_size))
+        if not page:
+            return ids
+        ids.extend(entry.id for entry in page)
+        where = _entries_after(page[-1].last_updated_on, page[-1].id)
+
+def run_tests():
+    with scratch_database(DATABASE_FILENAME):
+        user, expected_ids = setup_entries()
+
+        # Walk forward like a client doing its first sync
+        ids, min_id = [], 0
+        while True:
+            page = get_entries_min(user, min_id)
+            if not page:
+                break
+            assert len(page) <= ITEMS_PER_PAGE
+            ids.extend(item['id'] for item in page)
+            min_id = page[-1]['id']
+        assert ids == expected_ids
+
+        # Walk backward from the latest items
+        ids, max_id = [], 0
+        while True:
+            page = get_entries_max(user, max_id)
+            if not page:
+                break
+            assert len(page) <= ITEMS_PER_PAGE
+            ids.extend(item['id'] for item in page)
+            max_id = page[-1]['id']
+        assert ids == expected_ids[::-1]
+
+        # Page size is capped
+        assert len(get_entries_min(user, 0, bound=1000)) == ITEMS_PER_PAGE
+
+        check_query_plan(_q_entries_min(user, expected_ids[10]))
+        check_query_plan(_q_entries_max(user, expected_ids[-10]))
+        check_query_plan(_q_entries_max(user))
+
+        # Same update time for all entries, id alone breaks ties
+        controller = UserController()
+        controller.user = user
+        assert walk_entry_list(controller.get_all_entries()) == expected_ids[::-1]
+
+        entry = Entry.get(Entry.id == expected_ids[-10])
+        check_query_plan(controller.get_all_entries().where(_entries_after(entry.last_updated_on, entry.id)).order_by(*ENTRIES_ORDER).limit(30), 
+            'INDEX entries_last_updated_on_id')
+
+        # Unread entries are walked the same way, not sorted all at once
+        controller.check_unread_entries()
+        assert walk_entry_list(controller.get_unread_entries()) == expected_ids[::-1]
+        check_query_plan(controller.get_unread_entries().where(_entries_after(entry.last_updated_on, entry.id)).order_by(*ENTRIES_ORDER).limit(30), 
+            'INDEX entries_last_updated_on_id')
+
+if __name__ == '__main__':
+    run_tests()
@@ -34,6 +34,13 @@ def make_data_uri(content_type, data):
     """
     return "data:%s;base64,%s" % (content_type, base64.standard_b64encode(data))
 
+def parse_data_uri(value):
+    """
+    Return content type and decoded data of a base64 data:URI
+    """
+    header, data = value.split(',', 1)
+    return header[5:].split(';')[0], base64.standard_b64decode(data)
+
 
 # --------------------
 # Hash functions
@@ -138,8 +145,42 @@ def datetime_since_today(value, comparison_value=None):
 # Misc.
 # --------------------
 
-# def render_template(filename, namespace):                    
-#     return HTMLTemplate.from_filename(filename, namespace=namespace).substitute()
+class TemplateCache(object):
+    '''
+    Compiled templates by class and path. With reload set template 
+      files are checked for changes on every lookup
+    '''
+
+    def __init__(self, reload=False):
+        self.reload = reload
+        self._templates = {} # (class, path) -> (mtime, template)
+
+    def get(self, filename, template_class=HTMLTemplate):
+        key = template_class, filename
+        mtime = os.path.getmtime(filename) if self.reload else None
+        try:
+            template_mtime, template = self._templates[key]
+            if template_mtime == mtime:
+                return template
+        except KeyError:
+            pass
+        # Inherited templates are looked up here too
+        template = template_class.from_filename(filename, get_template=self._get_inherited)
+        self._templates[key] = mtime, template
+        return template
+
+    def _get_inherited(self, name, from_template):
+        return self.get(os.path.join(os.path.dirname(from_template.name), name), from_template.__class__)
+
+    def preload(self, dirname, template_class=HTMLTemplate):
+        '''
+        Compile every template found in dirname
+        '''
+        for name in os.listdir(dirname):
+            self.get(os.path.join(dirname, name), template_class)
+
+# Shared by all modules, see web.reload_templates option
+template_cache = TemplateCache()
 
 def render_template(filename, namespace, filters_module=None):                    
     # Install template filters if given
@@ -152,7 +193,7 @@ def render_template(filename, namespace, filters_module=None):
         del filters_namespace['html'] 
         # Update namespace, possibly overriding names
         namespace.update(filters_namespace)
-    return HTMLTemplate.from_filename(filename, namespace=namespace).substitute()
+    return template_cache.get(filename).substitute(namespace)
         
 class Struct(dict):
     """
@@ -188,6 +229,7 @@ def run_tests():
     t = datetime.utcnow()                
     print format_http_datetime(t)
     assert truncate(u'Lorèm ipsum dolor sit ame', 10) == u'Lorèm ips…'
+    assert parse_data_uri(make_data_uri('image/png', 'PNG')) == ('image/png', 'PNG')
     
 if __name__ == '__main__':
     run_tests()